@@ -5,6 +5,15 @@
 Nice long listing of all 256 colors and their codes. Useful for
 developing console color themes, or even script output schemes.
 
+It can be imported as a module too, tables are built on first use and
+NumPy is only imported for batch conversions, e.g.:
+
+    >>> from colortrans import rgb_int_to_short, short_to_rgb_int
+    >>> rgb_int_to_short(0xABCDEF), hex(short_to_rgb_int(153))
+    (153, '0xafd7ff')
+
+Run the doctests with `python -m doctest colortrans.py`.
+
 Resources:
 * http://en.wikipedia.org/wiki/8-bit_color
 * http://en.wikipedia.org/wiki/ANSI_escape_code
@@ -22,7 +31,13 @@ __license__ = "WTFPL http://sam.zoy.org/wtfpl/"
 # ---------------------------------------------------------------------
 
 import sys
-import re
+import os
+import math
+from array import array
+from functools import lru_cache
+
+np = None  # NumPy, imported on first use by _import_numpy
+_numpy_imported = False
 
 CLUT = [  # color look-up table
     #    8-bit, RGB hex
@@ -289,6 +304,1101 @@ CLUT = [  # color look-up table
 ]
 
 
+def _import_numpy():
+    """Import NumPy on first use, so importing this module stays cheap.
+    @returns: the numpy module, or None when it's not installed
+    """
+    global np, _numpy_imported
+    if not _numpy_imported:
+        try:
+            import numpy
+        except ImportError:  # batch conversions fall back to pure Python
+            numpy = None
+        np, _numpy_imported = numpy, True
+    return np
+
+
+@lru_cache(maxsize=None)
+def _regex(pattern):
+    import re
+
+    return re.compile(pattern)
+
+
+@lru_cache(maxsize=None)
+def _palette_table():
+    """Packed 0xRRGGBB values of all 256 colors, indexed by color code."""
+    return array("I", (int(rgb, 16) for _, rgb in CLUT))
+
+
+def short_to_rgb_int(short: int) -> int:
+    """Return the RGB value of an xterm-256 color as an 0xRRGGBB integer.
+    >>> hex(short_to_rgb_int(23))
+    '0x5f5f'
+    """
+    if not 0 <= short < 256:
+        raise ValueError("xterm color %d is out of range 0-255" % short)
+    return _palette_table()[short]
+
+
+def rgb_int_to_short(rgb: int) -> int:
+    """Find the closest xterm-256 color (16-255) to an 0xRRGGBB integer.
+    >>> rgb_int_to_short(0x123456)
+    23
+    """
+    if not 0 <= rgb <= 0xFFFFFF:
+        raise ValueError("RGB value %#x is out of range" % rgb)
+    return rgb2short_int(rgb >> 16, (rgb >> 8) & 0xFF, rgb & 0xFF)
+
+
+# Levels of each channel in the 6x6x6 color cube (16-231).
+CUBE_LEVELS = (0x00, 0x5F, 0x87, 0xAF, 0xD7, 0xFF)
+# Gray-scale ramp (232-255) levels are 8, 18, ..., 238.
+GRAY_LEVELS = tuple(range(8, 248, 10))
+
+
+def _create_quantization_tables():
+    """Map each channel value (0-255) to the nearest cube level index,
+    and to the nearest gray-scale ramp index."""
+    # ties go to the bigger level, so each level starts halfway from the
+    # previous one, rounded up
+    starts = [0]
+    starts += [(low + high + 1) // 2 for low, high in zip(CUBE_LEVELS, CUBE_LEVELS[1:])]
+    starts.append(256)
+    cube_index = b"".join(bytes((i,)) * (starts[i + 1] - starts[i]) for i in range(6))
+    gray_index = bytes(min(23, max(0, (value - 3) // 10)) for value in range(256))
+    return cube_index, gray_index
+
+
+def rgb2short_int(r, g, b):
+    """Find the closest xterm-256 color (16-255) to the RGB channel values,
+    from the color cube or the gray-scale ramp.
+    @returns: int between 16 and 255
+    >>> rgb2short_int(0x12, 0x34, 0x56)
+    23
+    >>> rgb2short_int(0x80, 0x80, 0x80)
+    244
+    >>> rgb2short_int(255, 255, 255)
+    231
+    """
+    ri = _CUBE_INDEX[r]
+    gi = _CUBE_INDEX[g]
+    bi = _CUBE_INDEX[b]
+    dr = r - CUBE_LEVELS[ri]
+    dg = g - CUBE_LEVELS[gi]
+    db = b - CUBE_LEVELS[bi]
+    cube_dist = dr * dr + dg * dg + db * db
+    if not cube_dist:
+        return 16 + 36 * ri + 6 * gi + bi
+    yi = _GRAY_INDEX[(r + g + b) // 3]
+    gray = GRAY_LEVELS[yi]
+    dr = r - gray
+    dg = g - gray
+    db = b - gray
+    if dr * dr + dg * dg + db * db < cube_dist:
+        return 232 + yi
+    return 16 + 36 * ri + 6 * gi + bi
+
+
+BATCH_CHUNK_SIZE = 1 << 20  # colors converted at once, bounds temporary arrays
+
+
+def rgb2short_array(colors, metric=None):
+    """Find the closest xterm-256 colors to many RGB colors at once.
+    Uses NumPy when available, otherwise converts each color with rgb2short_int.
+    @param colors: NumPy array of shape (N, 3) of uint8 RGB values, or a
+        bytes-like buffer of packed RGB triplets
+    @param metric: if set, search the whole palette by the color distance
+        metric (see rgb2short_metric)
+    @returns: NumPy uint8 array of N xterm colors, or bytes without NumPy
+    >>> bytes(rgb2short_array(b"\\x12\\x34\\x56\\x80\\x80\\x80"))
+    b'\\x17\\xf4'
+    """
+    if _import_numpy() is None:
+        buf = memoryview(colors).cast("B")
+        convert = rgb2short_int
+        if metric is not None:
+            convert = lambda r, g, b: rgb2short_metric(r, g, b, metric)  # noqa: E731
+        return bytes(
+            convert(buf[i], buf[i + 1], buf[i + 2]) for i in range(0, len(buf), 3)
+        )
+    if isinstance(colors, np.ndarray):
+        rgb = colors.reshape(-1, 3).astype(np.uint8, copy=False)
+    else:
+        rgb = np.frombuffer(colors, dtype=np.uint8).reshape(-1, 3)
+    if metric is not None:
+        table = np.frombuffer(metric_table(metric), dtype=np.uint8)
+        codes = rgb.astype(np.int32)
+        return table[(codes[:, 0] << 16) | (codes[:, 1] << 8) | codes[:, 2]]
+    cube_index = np.frombuffer(_CUBE_INDEX, dtype=np.uint8)
+    gray_index = np.frombuffer(_GRAY_INDEX, dtype=np.uint8)
+    cube_levels = np.array(CUBE_LEVELS, dtype=np.int32)
+    gray_levels = np.array(GRAY_LEVELS, dtype=np.int32)
+    result = np.empty(len(rgb), dtype=np.uint8)
+    for start in range(0, len(rgb), BATCH_CHUNK_SIZE):
+        chunk = rgb[start : start + BATCH_CHUNK_SIZE].astype(np.int32)
+        ci = cube_index[chunk]  # (n, 3) cube level index of each channel
+        cube_diff = chunk - cube_levels[ci]
+        cube_dist = (cube_diff * cube_diff).sum(axis=1)
+        yi = gray_index[chunk.sum(axis=1) // 3]
+        gray_diff = chunk - gray_levels[yi][:, None]
+        gray_dist = (gray_diff * gray_diff).sum(axis=1)
+        cube = 16 + 36 * ci[:, 0] + 6 * ci[:, 1] + ci[:, 2]
+        result[start : start + len(chunk)] = np.where(
+            gray_dist < cube_dist, 232 + yi, cube
+        )
+    return result
+
+
+# ---------------------------------------------------------------------
+# Perceptual color distance metrics, searching the whole palette (0-255).
+
+METRICS = ("rgb", "redmean", "lab76", "de2000")
+METRIC_TABLE_VERSION = 1
+METRIC_TABLE_CHUNK_SIZE = 1 << 15
+DE2000_GRID_STEP = 4  # CIEDE2000 tables search the whole palette on this grid
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "colortrans"
+)
+# search order of the palette, ties prefer the colors that terminals don't redefine
+PALETTE_ORDER = tuple(range(16, 256)) + tuple(range(16))
+# sRGB (D65) to CIE XYZ, and the D65 reference white
+RGB2XYZ = (
+    (0.4124564, 0.3575761, 0.1804375),
+    (0.2126729, 0.7151522, 0.0721750),
+    (0.0193339, 0.1191920, 0.9503041),
+)
+WHITE_D65 = (0.95047, 1.0, 1.08883)
+
+_metric_tables = {}
+
+
+def _linear(c):
+    c /= 255.0
+    return c / 12.92 if c <= 0.04045 else ((c + 0.055) / 1.055) ** 2.4
+
+
+def _lab_f(t):
+    if t > (6.0 / 29) ** 3:
+        return t ** (1.0 / 3)
+    return t / (3 * (6.0 / 29) ** 2) + 4.0 / 29
+
+
+def rgb2lab(r, g, b):
+    """Convert sRGB channel values to CIELAB (D65).
+    >>> ["%.2f" % v for v in rgb2lab(255, 0, 0)]
+    ['53.24', '80.09', '67.20']
+    """
+    linear = (_linear(r), _linear(g), _linear(b))
+    x, y, z = (
+        _lab_f(sum(m * c for m, c in zip(row, linear)) / white)
+        for row, white in zip(RGB2XYZ, WHITE_D65)
+    )
+    return 116 * y - 16, 500 * (x - y), 200 * (y - z)
+
+
+def delta_e2000(lab1, lab2):
+    """CIEDE2000 color difference of two CIELAB colors.
+    >>> "%.4f" % delta_e2000((50, 2.6772, -79.7751), (50, 0, -82.7485))
+    '2.0425'
+    """
+    l1, a1, b1 = lab1
+    l2, a2, b2 = lab2
+    c_mean = (math.hypot(a1, b1) + math.hypot(a2, b2)) / 2
+    g = 0.5 * (1 - math.sqrt(c_mean**7 / (c_mean**7 + 25.0**7)))
+    a1, a2 = a1 * (1 + g), a2 * (1 + g)
+    c1, c2 = math.hypot(a1, b1), math.hypot(a2, b2)
+    h1 = math.degrees(math.atan2(b1, a1)) % 360 if c1 else 0.0
+    h2 = math.degrees(math.atan2(b2, a2)) % 360 if c2 else 0.0
+    dl, dc = l2 - l1, c2 - c1
+    dh = h2 - h1
+    if dh > 180:
+        dh -= 360
+    elif dh < -180:
+        dh += 360
+    if not c1 * c2:
+        dh = 0.0
+    dh = 2 * math.sqrt(c1 * c2) * math.sin(math.radians(dh / 2))
+    l_mean, c_mean = (l1 + l2) / 2, (c1 + c2) / 2
+    h_mean = h1 + h2
+    if c1 * c2:
+        if abs(h1 - h2) > 180:
+            h_mean += 360 if h_mean < 360 else -360
+        h_mean /= 2
+    t = (
+        1
+        - 0.17 * math.cos(math.radians(h_mean - 30))
+        + 0.24 * math.cos(math.radians(2 * h_mean))
+        + 0.32 * math.cos(math.radians(3 * h_mean + 6))
+        - 0.20 * math.cos(math.radians(4 * h_mean - 63))
+    )
+    d_theta = 30 * math.exp(-(((h_mean - 275) / 25) ** 2))
+    rc = 2 * math.sqrt(c_mean**7 / (c_mean**7 + 25.0**7))
+    sl = 1 + 0.015 * (l_mean - 50) ** 2 / math.sqrt(20 + (l_mean - 50) ** 2)
+    sc = 1 + 0.045 * c_mean
+    sh = 1 + 0.015 * c_mean * t
+    rt = -math.sin(math.radians(2 * d_theta)) * rc
+    return math.sqrt(
+        (dl / sl) ** 2 + (dc / sc) ** 2 + (dh / sh) ** 2 + rt * (dc / sc) * (dh / sh)
+    )
+
+
+def color_distance(rgb1, rgb2, metric="de2000"):
+    """Distance of two (r, g, b) colors by the metric, only comparable
+    with other distances of the same metric."""
+    if metric == "rgb" or metric == "redmean":
+        dr, dg, db = (c1 - c2 for c1, c2 in zip(rgb1, rgb2))
+        if metric == "rgb":
+            return dr * dr + dg * dg + db * db
+        r_mean = (rgb1[0] + rgb2[0]) / 2
+        return (2 + r_mean / 256) * dr * dr + 4 * dg * dg + (
+            2 + (255 - r_mean) / 256
+        ) * db * db
+    lab1, lab2 = rgb2lab(*rgb1), rgb2lab(*rgb2)
+    if metric == "lab76":
+        return sum((c1 - c2) ** 2 for c1, c2 in zip(lab1, lab2))
+    if metric == "de2000":
+        return delta_e2000(lab1, lab2)
+    raise ValueError("unknown color metric '%s'" % metric)
+
+
+@lru_cache(maxsize=None)
+def _palette_rgb():
+    return tuple((rgb >> 16, (rgb >> 8) & 0xFF, rgb & 0xFF) for rgb in _palette_table())
+
+
+@lru_cache(maxsize=65536)
+def _nearest_short(r, g, b, metric):
+    palette = _palette_rgb()
+    return min(
+        PALETTE_ORDER, key=lambda i: color_distance((r, g, b), palette[i], metric)
+    )
+
+
+def _rgb2lab_np(rgb):
+    c = rgb / 255.0
+    linear = np.where(c <= 0.04045, c / 12.92, ((c + 0.055) / 1.055) ** 2.4)
+    xyz = linear @ np.array(RGB2XYZ).T / np.array(WHITE_D65)
+    f = np.where(
+        xyz > (6.0 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6.0 / 29) ** 2) + 4.0 / 29
+    )
+    x, y, z = f[..., 0], f[..., 1], f[..., 2]
+    return np.stack((116 * y - 16, 500 * (x - y), 200 * (y - z)), axis=-1)
+
+
+def _delta_e2000_np(lab1, lab2):
+    l1, a1, b1 = lab1[..., 0], lab1[..., 1], lab1[..., 2]
+    l2, a2, b2 = lab2[..., 0], lab2[..., 1], lab2[..., 2]
+    c_mean = (np.hypot(a1, b1) + np.hypot(a2, b2)) / 2
+    g = 0.5 * (1 - np.sqrt(c_mean**7 / (c_mean**7 + 25.0**7)))
+    a1, a2 = a1 * (1 + g), a2 * (1 + g)
+    c1, c2 = np.hypot(a1, b1), np.hypot(a2, b2)
+    h1 = np.degrees(np.arctan2(b1, a1)) % 360
+    h2 = np.degrees(np.arctan2(b2, a2)) % 360
+    chroma = c1 * c2 != 0
+    dl, dc = l2 - l1, c2 - c1
+    dh = h2 - h1
+    dh = np.where(dh > 180, dh - 360, np.where(dh < -180, dh + 360, dh))
+    dh = np.where(chroma, dh, 0.0)
+    dh = 2 * np.sqrt(c1 * c2) * np.sin(np.radians(dh / 2))
+    l_mean, c_mean = (l1 + l2) / 2, (c1 + c2) / 2
+    h_sum = h1 + h2
+    h_mean = np.where(
+        np.abs(h1 - h2) > 180,
+        np.where(h_sum < 360, h_sum + 360, h_sum - 360) / 2,
+        h_sum / 2,
+    )
+    h_mean = np.where(chroma, h_mean, h_sum)
+    t = (
+        1
+        - 0.17 * np.cos(np.radians(h_mean - 30))
+        + 0.24 * np.cos(np.radians(2 * h_mean))
+        + 0.32 * np.cos(np.radians(3 * h_mean + 6))
+        - 0.20 * np.cos(np.radians(4 * h_mean - 63))
+    )
+    d_theta = 30 * np.exp(-(((h_mean - 275) / 25) ** 2))
+    rc = 2 * np.sqrt(c_mean**7 / (c_mean**7 + 25.0**7))
+    sl = 1 + 0.015 * (l_mean - 50) ** 2 / np.sqrt(20 + (l_mean - 50) ** 2)
+    sc = 1 + 0.045 * c_mean
+    sh = 1 + 0.015 * c_mean * t
+    rt = -np.sin(np.radians(2 * d_theta)) * rc
+    return np.sqrt(
+        (dl / sl) ** 2 + (dc / sc) ** 2 + (dh / sh) ** 2 + rt * (dc / sc) * (dh / sh)
+    )
+
+
+def _metric_features(metric, rgb, lab):
+    """Return per color features X and per palette color weights W, such that
+    argmin(X @ W) is the nearest palette color by the metric (terms that only
+    depend on the color are left out as they don't change the argmin)."""
+    ones = np.ones(len(rgb))
+    palette = np.array(_palette_rgb(), dtype=np.float64)[list(PALETTE_ORDER)]
+    if metric in ("rgb", "lab76"):
+        colors, targets = rgb, palette
+        if metric == "lab76":
+            colors, targets = lab, _rgb2lab_np(palette)
+        features = np.column_stack((ones, colors))
+        weights = np.vstack(((targets * targets).sum(axis=1), -2 * targets.T))
+        return features, weights
+    # redmean expanded to polynomial terms of the color channels
+    r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    p, q, s = palette[:, 0], palette[:, 1], palette[:, 2]
+    k = 2 + 255.0 / 256
+    features = np.column_stack((ones, r, r * r, g, b, b * b, r * b))
+    weights = np.vstack(
+        (
+            2 * p * p + p**3 / 512 + 4 * q * q + k * s * s - p * s * s / 512,
+            -4 * p - p * p / 512 - s * s / 512,
+            -p / 512,
+            -8 * q,
+            -2 * k * s + 2 * p * s / 512,
+            -p / 512,
+            2 * s / 512,
+        )
+    )
+    return features, weights
+
+
+def _build_de2000_table(order, palette_lab):
+    """CIEDE2000 is too slow to compare every 24-bit color with the whole
+    palette. The whole palette is searched on a grid, and colors inside a
+    grid cell are compared with the colors nearest to the cell corners only,
+    if the corners don't already agree."""
+    grid = np.append(np.arange(0, 256, DE2000_GRID_STEP), 255)
+    size = len(grid)
+    grid_rgb = np.stack(np.meshgrid(grid, grid, grid, indexing="ij"), axis=-1)
+    grid_rgb = grid_rgb.reshape(-1, 3).astype(np.float64)
+    grid_nearest = np.empty(len(grid_rgb), dtype=np.intp)
+    chunk_size = METRIC_TABLE_CHUNK_SIZE // len(order)
+    for start in range(0, len(grid_rgb), chunk_size):
+        lab = _rgb2lab_np(grid_rgb[start : start + chunk_size])
+        de = _delta_e2000_np(lab[:, None, :], palette_lab[None, :, :])
+        grid_nearest[start : start + chunk_size] = de.argmin(axis=1)
+    grid_nearest = grid_nearest.reshape(size, size, size)
+
+    cell = np.minimum(np.arange(256) // DE2000_GRID_STEP, size - 2)
+    green_blue = np.arange(1 << 16)
+    green, blue = green_blue >> 8, green_blue & 0xFF
+    cell_green, cell_blue = cell[green], cell[blue]
+    table = np.empty(1 << 24, dtype=np.uint8)
+    for red in range(256):  # one plane of 65536 colors at a time
+        cell_red = cell[red]
+        corners = np.stack(
+            [
+                grid_nearest[cell_red + i, cell_green + j, cell_blue + k]
+                for i in (0, 1)
+                for j in (0, 1)
+                for k in (0, 1)
+            ],
+            axis=1,
+        )
+        nearest = corners[:, 0].copy()
+        mixed = (corners != corners[:, :1]).any(axis=1)
+        if mixed.any():
+            rgb = np.stack(
+                (np.full(mixed.sum(), red), green[mixed], blue[mixed]), axis=1
+            )
+            lab = _rgb2lab_np(rgb.astype(np.float64))
+            candidates = corners[mixed]
+            de = _delta_e2000_np(lab[:, None, :], palette_lab[candidates])
+            nearest[mixed] = candidates[np.arange(len(candidates)), de.argmin(axis=1)]
+        table[red << 16 : (red + 1) << 16] = order[nearest]
+    return table
+
+
+def _build_metric_table(metric):
+    """Return the nearest palette color of every 24-bit color by the metric."""
+    order = np.array(PALETTE_ORDER, dtype=np.uint8)
+    palette = np.array(_palette_rgb(), dtype=np.float64)[order]
+    if metric == "de2000":
+        return _build_de2000_table(order, _rgb2lab_np(palette)).tobytes()
+    table = np.empty(1 << 24, dtype=np.uint8)
+    for start in range(0, 1 << 24, METRIC_TABLE_CHUNK_SIZE):
+        codes = np.arange(start, start + METRIC_TABLE_CHUNK_SIZE)
+        table[start : start + len(codes)] = _nearest_shorts(codes, metric)
+    return table.tobytes()
+
+
+def _nearest_shorts(codes, metric):
+    """Return the nearest palette colors of a NumPy array of 0xRRGGBB codes
+    by the metric, the same colors _nearest_short finds one by one (de2000
+    tables are built on a grid instead, see _build_de2000_table).
+    >>> import random
+    >>> np = _import_numpy()
+    >>> codes = [random.Random(seed).randrange(1 << 24) for seed in range(500)]
+    >>> np is None or all(
+    ...     _nearest_shorts(np.array(codes), metric).tolist()
+    ...     == [
+    ...         _nearest_short(code >> 16, (code >> 8) & 0xFF, code & 0xFF, metric)
+    ...         for code in codes
+    ...     ]
+    ...     for metric in ("rgb", "redmean", "lab76")
+    ... )
+    True
+    """
+    order = np.array(PALETTE_ORDER, dtype=np.uint8)
+    rgb = np.stack((codes >> 16, (codes >> 8) & 0xFF, codes & 0xFF), axis=1)
+    rgb = rgb.astype(np.float64)
+    lab = _rgb2lab_np(rgb) if metric == "lab76" else None
+    features, weights = _metric_features(metric, rgb, lab)
+    return order[(features @ weights).argmin(axis=1)]
+
+
+def metric_table(metric):
+    """Return the 16 MiB table of the nearest palette color of each 24-bit
+    color (indexed by 0xRRGGBB) by the metric, memory-mapped from the
+    cache directory. The table is built once with NumPy.
+    @returns: bytes-like table, or None if it's not cached and NumPy
+        is not available
+    """
+    if metric in _metric_tables:
+        return _metric_tables[metric]
+    if metric not in METRICS:
+        raise ValueError("unknown color metric '%s'" % metric)
+    import hashlib
+    import mmap
+
+    digest = hashlib.sha1(repr((METRIC_TABLE_VERSION, CLUT)).encode()).hexdigest()
+    path = os.path.join(CACHE_DIR, "%s-%s.lut" % (metric, digest[:12]))
+    if not os.path.exists(path):
+        if _import_numpy() is None:
+            return None
+        sys.stderr.write("building %s color table %s ...\n" % (metric, path))
+        table = _build_metric_table(metric)
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "wb") as lut:
+            lut.write(table)
+        os.replace(tmp_path, path)
+    with open(path, "rb") as lut:
+        table = mmap.mmap(lut.fileno(), 0, access=mmap.ACCESS_READ)
+    _metric_tables[metric] = table
+    return table
+
+
+def rgb2short_metric(r, g, b, metric="de2000"):
+    """Find the closest xterm-256 color (0-255) to the RGB channel values,
+    searching the whole palette by the color distance metric.
+    @param metric: one of METRICS
+    @returns: int between 0 and 255
+    """
+    table = metric_table(metric)
+    if table is None:
+        return _nearest_short(r, g, b, metric)
+    return table[(r << 16) | (g << 8) | b]
+
+
+# ---------------------------------------------------------------------
+# Downsample truecolor escape sequences of a stream to xterm-256 colors.
+
+FILTER_CHUNK_SIZE = 1 << 20
+MAX_SGR_LENGTH = 64  # longest escape sequence kept for the next chunk
+MAX_SGR_CACHE = 1 << 16
+# SGR sequences with a truecolor foreground or background
+_TRUECOLOR_SGR = rb"\x1b\[(?:[0-9;]*;)?[34]8;2;[0-9;]*m"
+# an escape sequence cut at the end of a chunk, that may be an SGR sequence
+_PARTIAL_SGR = rb"\x1b(?:\[[0-9;]*)?\Z"
+_TRUECOLOR_PARAMS = rb"([34]8);2;([0-9]{1,3});([0-9]{1,3});([0-9]{1,3})(?=[;m])"
+
+
+def _downsample_params(match):
+    r, g, b = int(match.group(2)), int(match.group(3)), int(match.group(4))
+    if r > 255 or g > 255 or b > 255:
+        return match.group(0)
+    return b"%s;5;%d" % (match.group(1), rgb2short_int(r, g, b))
+
+
+def downsample_sgr(sequence):
+    """Rewrite truecolor colors of an SGR escape sequence to xterm-256 colors.
+    >>> downsample_sgr(b"\\x1b[1;38;2;18;52;86;48;2;128;128;128m")
+    b'\\x1b[1;38;5;23;48;5;244m'
+    """
+    return _regex(_TRUECOLOR_PARAMS).sub(_downsample_params, sequence)
+
+
+def downsample_stream(infile, outfile, chunk_size=FILTER_CHUNK_SIZE):
+    """Copy a binary stream, rewriting truecolor SGR escape sequences to
+    xterm-256 colors. Data is written as soon as it's read, in chunks of
+    up to chunk_size bytes, and each distinct sequence is converted once.
+    Only an SGR sequence cut at the end of a chunk waits for the next one.
+    >>> class Writes(list):
+    ...     write = list.append
+    ...     def flush(self):
+    ...         pass
+    >>> read_fd, write_fd = os.pipe()
+    >>> os.write(write_fd, b"\\x1b[38;2;255;0;0mXabcde\\x1b[K\\x1b[0m")
+    28
+    >>> os.close(write_fd)
+    >>> writes = Writes()
+    >>> with os.fdopen(read_fd, "rb") as infile:
+    ...     downsample_stream(infile, writes, chunk_size=8)
+    >>> writes
+    [b'\\x1b[38;5;196mX', b'abcde\\x1b[K', b'\\x1b[0m']
+    """
+    cache = {}
+
+    def replace(match):
+        sequence = match.group()
+        replacement = cache.get(sequence)
+        if replacement is None:
+            if len(cache) >= MAX_SGR_CACHE:
+                cache.clear()
+            replacement = cache[sequence] = downsample_sgr(sequence)
+        return replacement
+
+    sub = _regex(_TRUECOLOR_SGR).sub
+    partial = _regex(_PARTIAL_SGR).search
+    fd = infile.fileno()
+    pending = b""
+    while True:
+        chunk = os.read(fd, chunk_size)
+        if not chunk:
+            break
+        data = pending + chunk if pending else chunk
+        # keep an SGR sequence that may continue in the next chunk, other
+        # (complete) sequences like cursor movements are written right away
+        match = partial(data, max(0, len(data) - MAX_SGR_LENGTH))
+        if match:
+            data, pending = data[: match.start()], data[match.start() :]
+        else:
+            pending = b""
+        if data:
+            outfile.write(sub(replace, data))
+            outfile.flush()
+    if pending:
+        outfile.write(sub(replace, pending))
+        outfile.flush()
+
+
+# ---------------------------------------------------------------------
+# Rendering images as half-block (upper half foreground, lower half
+# background) cells of xterm-256 colors.
+
+DITHERS = ("none", "ordered", "floyd-steinberg")
+HALF_BLOCK = "▀".encode()
+ORDERED_DITHER_SPREAD = 48  # roughly a step of the color cube
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# bytes per pixel of 8-bit PNG color types: gray, RGB, gray+alpha, RGBA
+_PNG_CHANNELS = {0: 1, 2: 3, 4: 2, 6: 4}
+
+
+@lru_cache(maxsize=None)
+def _bayer_matrix(size=8):
+    matrix = [[0]]
+    while len(matrix) < size:
+        n = len(matrix)
+        matrix = [
+            [
+                4 * matrix[y % n][x % n] + (0, 2, 3, 1)[(y // n) * 2 + x // n]
+                for x in range(2 * n)
+            ]
+            for y in range(2 * n)
+        ]
+    return matrix
+
+
+def _read_ppm_token(infile):
+    token = b""
+    while True:
+        char = infile.read(1)
+        if not char:
+            break
+        if char == b"#":
+            infile.readline()
+        elif char.isspace():
+            if token:
+                break
+        else:
+            token += char
+    return token
+
+
+def read_ppm(infile):
+    """Read a binary (P6) PPM image from a binary file.
+    Several images can be read from the same stream, one per call.
+    @returns: (width, height, packed RGB bytes), or None at end of the stream
+    """
+    magic = infile.read(2)
+    while magic[:1].isspace():
+        magic = magic[1:] + infile.read(1)
+    if not magic:
+        return None
+    if magic != b"P6":
+        raise ValueError("not a binary PPM image")
+    width, height, maxval = (int(_read_ppm_token(infile)) for _ in range(3))
+    if not 0 < maxval < 65536:
+        raise ValueError("invalid PPM maximum value %d" % maxval)
+    sample_size = 1 if maxval < 256 else 2
+    data = infile.read(width * height * 3 * sample_size)
+    if len(data) < width * height * 3 * sample_size:
+        raise ValueError("truncated PPM image")
+    if sample_size == 2:
+        data = bytes(
+            ((data[i] << 8 | data[i + 1]) * 255 + maxval // 2) // maxval
+            for i in range(0, len(data), 2)
+        )
+    elif maxval != 255:
+        data = bytes((c * 255 + maxval // 2) // maxval for c in data)
+    return width, height, data
+
+
+def _png_unfilter(data, width, height, bpp):
+    stride = width * bpp
+    if len(data) < height * (stride + 1):
+        raise ValueError("truncated PNG image data")
+    rows = []
+    previous = bytearray(stride)
+    pos = 0
+    for _ in range(height):
+        kind, row = data[pos], bytearray(data[pos + 1 : pos + 1 + stride])
+        pos += stride + 1
+        if kind == 1:
+            for i in range(bpp, stride):
+                row[i] = (row[i] + row[i - bpp]) & 0xFF
+        elif kind == 2:
+            row = bytearray((a + b) & 0xFF for a, b in zip(row, previous))
+        elif kind == 3:
+            for i in range(stride):
+                left = row[i - bpp] if i >= bpp else 0
+                row[i] = (row[i] + ((left + previous[i]) >> 1)) & 0xFF
+        elif kind == 4:
+            for i in range(stride):
+                a = row[i - bpp] if i >= bpp else 0
+                b = previous[i]
+                c = previous[i - bpp] if i >= bpp else 0
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                if pa <= pb and pa <= pc:
+                    predictor = a
+                elif pb <= pc:
+                    predictor = b
+                else:
+                    predictor = c
+                row[i] = (row[i] + predictor) & 0xFF
+        elif kind != 0:
+            raise ValueError("invalid PNG filter type %d" % kind)
+        rows.append(row)
+        previous = row
+    return b"".join(rows)
+
+
+def read_png(infile):
+    """Read an 8-bit, non-interlaced gray or RGB (optionally with alpha)
+    PNG image from a binary file. Alpha is ignored.
+    @returns: (width, height, packed RGB bytes)
+    """
+    import struct
+    import zlib
+
+    if infile.read(8) != PNG_SIGNATURE:
+        raise ValueError("not a PNG image")
+    header, chunks = None, []
+    while True:
+        try:
+            length, kind = struct.unpack(">I4s", infile.read(8))
+        except struct.error:
+            raise ValueError("truncated PNG image")
+        chunk = infile.read(length)
+        infile.read(4)  # CRC
+        if kind == b"IHDR":
+            try:
+                header = struct.unpack(">IIBBBBB", chunk)
+            except struct.error:
+                raise ValueError("invalid PNG image header")
+        elif kind == b"IDAT":
+            chunks.append(chunk)
+        elif kind == b"IEND":
+            break
+    if header is None:
+        raise ValueError("PNG image has no header")
+    width, height, depth, color_type, _, _, interlace = header
+    bpp = _PNG_CHANNELS.get(color_type)
+    if depth != 8 or bpp is None or interlace:
+        raise ValueError(
+            "unsupported PNG image (only 8-bit, non-interlaced gray or RGB images)"
+        )
+    try:
+        data = zlib.decompress(b"".join(chunks))
+    except zlib.error as err:
+        raise ValueError("invalid PNG image data: %s" % err)
+    data = _png_unfilter(data, width, height, bpp)
+    if bpp in (1, 2):
+        data = bytes(c for c in data[::bpp] for _ in range(3))
+    elif bpp == 4:
+        data = b"".join(data[i : i + 3] for i in range(0, len(data), 4))
+    return width, height, data
+
+
+def read_image(path):
+    """Read a PPM or PNG image file.
+    Uses Pillow when available for PNG images, so all of its formats are supported.
+    @returns: (width, height, packed RGB bytes)
+    """
+    with open(path, "rb") as infile:
+        magic = infile.read(8)
+        infile.seek(0)
+        if magic[:2] == b"P6":
+            return read_ppm(infile)
+        try:
+            from PIL import Image
+        except ImportError:
+            return read_png(infile)
+        image = Image.open(infile).convert("RGB")
+        return image.width, image.height, image.tobytes()
+
+
+def fit_size(width, height, max_width, max_height):
+    """Scale an image size to fit in max_width x max_height pixels, keeping
+    the aspect ratio. Images are never enlarged, and the height is rounded
+    to full rows of half-block cells.
+    >>> fit_size(640, 480, 80, 48)
+    (64, 48)
+    """
+    scale = min(1.0, max_width / width, max_height / height)
+    fitted_width = max(1, int(round(width * scale)))
+    fitted_height = max(2, int(round(height * scale / 2)) * 2)
+    return fitted_width, fitted_height
+
+
+def _resize(width, height, pixels, new_width, new_height):
+    """Resize packed RGB pixels by nearest neighbor sampling."""
+    xs = [x * width // new_width for x in range(new_width)]
+    ys = [y * height // new_height for y in range(new_height)]
+    if _import_numpy() is not None:
+        image = np.frombuffer(pixels, dtype=np.uint8).reshape(height, width, 3)
+        return image[np.array(ys)[:, None], np.array(xs)].tobytes()
+    offsets = [3 * x + c for x in xs for c in range(3)]
+    stride = width * 3
+    return b"".join(
+        bytes(map(pixels[y * stride : (y + 1) * stride].__getitem__, offsets))
+        for y in ys
+    )
+
+
+def _dither_ordered(width, height, pixels):
+    spread = ORDERED_DITHER_SPREAD / 64.0
+    if _import_numpy() is not None:
+        bayer = (np.array(_bayer_matrix(8), dtype=np.float32) + 0.5) * spread
+        bayer -= ORDERED_DITHER_SPREAD / 2.0
+        threshold = np.tile(bayer, (height // 8 + 1, width // 8 + 1))
+        image = np.frombuffer(pixels, dtype=np.uint8).reshape(height, width, 3)
+        image = image + threshold[:height, :width, None]
+        return rgb2short_array(np.clip(image + 0.5, 0, 255).astype(np.uint8))
+    offsets = [
+        [(value + 0.5) * spread - ORDERED_DITHER_SPREAD / 2.0 + 0.5 for value in row]
+        for row in _bayer_matrix(8)
+    ]
+    codes = bytearray(width * height)
+    for y in range(height):
+        row_offsets = offsets[y % 8]
+        for x in range(width):
+            i = y * width + x
+            d = row_offsets[x % 8]
+            codes[i] = rgb2short_int(
+                *(min(255, max(0, int(c + d))) for c in pixels[i * 3 : i * 3 + 3])
+            )
+    return bytes(codes)
+
+
+def _dither_floyd_steinberg_np(width, height, pixels):
+    # a pixel only depends on its left neighbor and the three pixels above,
+    # so pixels on the same wave of x + 2y are quantized together. errors
+    # are added in the same order as the sequential loop, for equal results
+    palette = np.array(_palette_rgb(), dtype=np.float64)
+    cube_index = np.frombuffer(_CUBE_INDEX, dtype=np.uint8).astype(np.intp)
+    gray_index = np.frombuffer(_GRAY_INDEX, dtype=np.uint8).astype(np.intp)
+    cube_levels = np.array(CUBE_LEVELS, dtype=np.intp)
+    gray_levels = np.array(GRAY_LEVELS, dtype=np.intp)
+    # padded by a row below and a column on each side, errors pushed out of
+    # the image are never read
+    work = np.zeros((height + 1, width + 2, 3), dtype=np.float64)
+    work[:height, 1:-1] = np.frombuffer(pixels, dtype=np.uint8).reshape(
+        height, width, 3
+    )
+    codes = np.empty((height, width), dtype=np.uint8)
+    for wave in range(width + 2 * (height - 1)):
+        ys = np.arange(max(0, (wave - width + 2) // 2), min(height - 1, wave // 2) + 1)
+        xs = wave - 2 * ys + 1
+        values = work[ys, xs]
+        rgb = np.clip(values + 0.5, 0, 255).astype(np.intp)
+        # same as rgb2short_array, without its per call setup
+        ci = cube_index[rgb]
+        cube_diff = rgb - cube_levels[ci]
+        yi = gray_index[rgb.sum(axis=1) // 3]
+        gray_diff = rgb - gray_levels[yi][:, None]
+        wave_codes = np.where(
+            (gray_diff * gray_diff).sum(axis=1) < (cube_diff * cube_diff).sum(axis=1),
+            232 + yi,
+            16 + 36 * ci[:, 0] + 6 * ci[:, 1] + ci[:, 2],
+        )
+        codes[ys, xs - 1] = wave_codes
+        errors = values - palette[wave_codes]
+        work[ys + 1, xs - 1] += errors * 0.1875
+        work[ys + 1, xs] += errors * 0.3125
+        work[ys + 1, xs + 1] += errors * 0.0625
+        work[ys, xs + 1] += errors * 0.4375
+    return codes.tobytes()
+
+
+def _dither_floyd_steinberg(width, height, pixels):
+    # error diffusion is sequential, each pixel is quantized with the
+    # rgb2short_int tables and its error is pushed to unvisited neighbors.
+    # without NumPy it's a loop over each pixel, fast enough for images
+    # scaled to the terminal size (see fit_size), not for big images
+    if _import_numpy() is not None:
+        return _dither_floyd_steinberg_np(width, height, pixels)
+    palette = _palette_rgb()
+    convert = rgb2short_int
+    codes = bytearray(width * height)
+    stride = width * 3
+    current = list(pixels[:stride])
+    for y in range(height):
+        below = list(pixels[(y + 1) * stride : (y + 2) * stride]) or [0] * stride
+        base = y * width
+        for x in range(width):
+            i = x * 3
+            r = min(255, max(0, int(current[i] + 0.5)))
+            g = min(255, max(0, int(current[i + 1] + 0.5)))
+            b = min(255, max(0, int(current[i + 2] + 0.5)))
+            code = convert(r, g, b)
+            codes[base + x] = code
+            pr, pg, pb = palette[code]
+            errors = (current[i] - pr, current[i + 1] - pg, current[i + 2] - pb)
+            for c, error in enumerate(errors):
+                if x + 1 < width:
+                    current[i + 3 + c] += error * 0.4375
+                    below[i + 3 + c] += error * 0.0625
+                if x:
+                    below[i - 3 + c] += error * 0.1875
+                below[i + c] += error * 0.3125
+        current = below
+    return bytes(codes)
+
+
+def quantize_image(width, height, pixels, dither="none"):
+    """Map packed RGB pixels to xterm-256 colors.
+    @param dither: one of DITHERS
+    @returns: bytes of width * height xterm colors
+    """
+    if dither == "none":
+        return bytes(rgb2short_array(pixels))
+    if dither == "ordered":
+        return bytes(_dither_ordered(width, height, pixels))
+    if dither == "floyd-steinberg":
+        return _dither_floyd_steinberg(width, height, pixels)
+    raise ValueError("unknown dither '%s'" % dither)
+
+
+def render_frame(width, height, codes, home=False):
+    """Render an image of xterm-256 colors (with an even height) as rows of
+    half-block cells, into a single buffer.
+    @param home: if True, move the cursor to the top left corner first
+    >>> render_frame(2, 2, bytes([196, 196, 21, 21]))
+    b'\\x1b[38;5;196;48;5;21m\\xe2\\x96\\x80\\xe2\\x96\\x80\\x1b[0m\\n'
+    """
+    sgr = {}
+    parts = [b"\x1b[H"] if home else []
+    append = parts.append
+    for y in range(0, height, 2):
+        top = codes[y * width : (y + 1) * width]
+        bottom = codes[(y + 1) * width : (y + 2) * width]
+        previous = None
+        for pair in zip(top, bottom):
+            if pair != previous:
+                sequence = sgr.get(pair)
+                if sequence is None:
+                    sequence = sgr[pair] = b"\x1b[38;5;%d;48;5;%dm" % pair
+                append(sequence)
+                previous = pair
+            append(HALF_BLOCK)
+        append(b"\x1b[0m\n")
+    return b"".join(parts)
+
+
+def render_image(
+    width, height, pixels, max_width, max_height, dither="none", home=False
+):
+    """Render packed RGB pixels as half-block cells, scaled down to fit in
+    max_width x max_height pixels (two pixels per cell vertically).
+    @returns: bytes of the whole frame
+    """
+    new_width, new_height = fit_size(width, height, max_width, max_height)
+    if (new_width, new_height) != (width, height):
+        pixels = _resize(width, height, pixels, new_width, new_height)
+    codes = quantize_image(new_width, new_height, pixels, dither)
+    return render_frame(new_width, new_height, codes, home)
+
+
+def render_stream(infile, outfile, max_width, max_height, dither="none", size=None):
+    """Render a stream of frames, each drawn over the previous one.
+    @param infile: binary file of concatenated PPM images, or of raw packed
+        RGB frames if size is set
+    @param size: (width, height) of raw frames
+    """
+    first = True
+    while True:
+        if size is None:
+            image = read_ppm(infile)
+            if image is None:
+                break
+        else:
+            data = infile.read(size[0] * size[1] * 3)
+            if len(data) < size[0] * size[1] * 3:
+                break
+            image = (size[0], size[1], data)
+        frame = render_image(*image, max_width, max_height, dither, home=True)
+        outfile.write(b"\x1b[2J" + frame if first else frame)
+        outfile.flush()
+        first = False
+
+
+# ---------------------------------------------------------------------
+# Compiling vim colorschemes, adding xterm-256 approximations of their
+# GUI colors to the highlight commands.
+
+VIM_COMPILED_VERSION = 1
+VIM_COMPILED_SUFFIX = "256"
+VIM_COMPILED_MARK = '" colortrans:'
+_VIM_HIGHLIGHT = r"^\s*hi(?:ghlight)?!?\s"
+_VIM_GUI_COLOR = r"\b(gui(?:fg|bg|sp))=#([0-9A-Fa-f]{6})\b"
+_VIM_COLORS_NAME = r"""(?m)^(\s*let\s+(?:g:)?colors_name\s*=\s*)(["'])(.*?)\2"""
+_VIM_CTERM_ATTRS = {"guifg": "ctermfg", "guibg": "ctermbg", "guisp": "ctermul"}
+
+
+def _vim_source_hash(source, metric):
+    key = "%d:%s:" % (VIM_COMPILED_VERSION, metric or "")
+    import hashlib
+
+    return hashlib.sha256(key.encode() + source).hexdigest()
+
+
+def _vim_compiled_hash(path):
+    try:
+        with open(path, "rb") as compiled:
+            header = compiled.readline().decode("utf-8", "replace")
+    except OSError:
+        return None
+    if not header.startswith(VIM_COMPILED_MARK):
+        return None
+    return header.split()[-1]
+
+
+def _vim_colorscheme_files(paths):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for name in sorted(os.listdir(path)):
+            file_path = os.path.join(path, name)
+            if name.endswith(".vim") and _vim_compiled_hash(file_path) is None:
+                yield file_path
+
+
+def _compile_vim_line(line, shorts):
+    colors = _regex(_VIM_GUI_COLOR).findall(line)
+    if not colors or not _regex(_VIM_HIGHLIGHT).match(line):
+        return line
+    attrs = [_VIM_CTERM_ATTRS[attr] for attr, _ in colors]
+    line = _regex(r"\s+(?:%s)=\S+" % "|".join(attrs)).sub("", line.rstrip("\n"))
+    return (
+        line
+        + "".join(
+            " %s=%d" % (cterm, shorts[color.lower()])
+            for cterm, (_, color) in zip(attrs, colors)
+        )
+        + "\n"
+    )
+
+
+def compile_vim_colors(paths, output_dir=None, metric=None, force=False):
+    """Write xterm-256 variants of vim colorschemes, named with the
+    VIM_COMPILED_SUFFIX. Highlight commands with GUI hex colors get the
+    matching ctermfg/ctermbg/ctermul, converting all colors of all files
+    in one batch. Colors set by functions or variables are left as they are.
+    A compiled file records the hash of its source, so unchanged schemes
+    are skipped unless force is True.
+    @param paths: colorscheme files, or directories of them
+    @param output_dir: where to write the variants, defaults to the
+        directory of each source
+    @returns: list of (source path, compiled path, status) tuples
+    """
+    results, pending = [], []
+    for path in _vim_colorscheme_files(paths):
+        with open(path, "rb") as source_file:
+            source = source_file.read()
+        name = os.path.splitext(os.path.basename(path))[0]
+        output_path = os.path.join(
+            output_dir or os.path.dirname(path), name + VIM_COMPILED_SUFFIX + ".vim"
+        )
+        digest = _vim_source_hash(source, metric)
+        if not force and _vim_compiled_hash(output_path) == digest:
+            results.append((path, output_path, "unchanged"))
+            continue
+        text = source.decode("utf-8", "replace")
+        lines = text.splitlines(True)
+        colors = [
+            color.lower()
+            for line in lines
+            if _regex(_VIM_HIGHLIGHT).match(line)
+            for _, color in _regex(_VIM_GUI_COLOR).findall(line)
+        ]
+        if not colors:
+            results.append((path, output_path, "no literal GUI colors"))
+            continue
+        pending.append((len(results), path, output_path, digest, lines, colors))
+        results.append(None)
+    unique = sorted({color for item in pending for color in item[-1]})
+    shorts = dict(
+        zip(unique, rgb2short_array(b"".join(bytes.fromhex(c) for c in unique), metric))
+    )
+    for index, path, output_path, digest, lines, colors in pending:
+        text = "".join(_compile_vim_line(line, shorts) for line in lines)
+        text = _regex(_VIM_COLORS_NAME).sub(
+            r"\g<1>\g<2>\g<3>%s\g<2>" % VIM_COMPILED_SUFFIX, text
+        )
+        header = "%s compiled from %s by %s %s\n" % (
+            VIM_COMPILED_MARK,
+            os.path.basename(path),
+            metric or "default",
+            digest,
+        )
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        tmp_path = "%s.%d.tmp" % (output_path, os.getpid())
+        with open(tmp_path, "w", encoding="utf-8") as compiled:
+            compiled.write(header + text)
+        os.replace(tmp_path, output_path)
+        results[index] = (path, output_path, "compiled %d colors" % len(colors))
+    return results
+
+
+def benchmark(count=1000000):
+    """Print the number of rgb2short_int conversions per second."""
+    import random
+    import time
+
+    colors = [
+        (random.randrange(256), random.randrange(256), random.randrange(256))
+        for _ in range(count)
+    ]
+    convert = rgb2short_int
+    started = time.perf_counter()
+    for r, g, b in colors:
+        convert(r, g, b)
+    elapsed = time.perf_counter() - started
+    print(
+        "%d conversions in %.3fs, %d conversions/s" % (count, elapsed, count / elapsed)
+    )
+    buf = bytes(random.randrange(256) for _ in range(count * 3))
+    started = time.perf_counter()
+    rgb2short_array(buf)
+    elapsed = time.perf_counter() - started
+    print(
+        "%d batch conversions in %.3fs, %d conversions/s (%s)"
+        % (count, elapsed, count / elapsed, "NumPy" if _import_numpy() else "Python")
+    )
+
+
 def _str2hex(hexstr):
     return int(hexstr, 16)
 
@@ -309,18 +1419,99 @@ def _create_dicts():
 
 
 def short2rgb(short):
-    return SHORT2RGB_DICT[short]
+    """Return the RGB hex code of an xterm-256 color code string.
+    >>> short2rgb('07')
+    'c0c0c0'
+    """
+    return "%06x" % short_to_rgb_int(int(short))
 
 
-def print_all():
-    """Print all 256 xterm color codes."""
-    for short, rgb in CLUT:
-        sys.stdout.write("\033[48;5;%sm%s:%s" % (short, short, rgb))
-        sys.stdout.write("\033[0m  ")
-        sys.stdout.write("\033[38;5;%sm%s:%s" % (short, short, rgb))
-        sys.stdout.write("\033[0m\n")
-    print("Printed all codes.")
-    print("You can translate a hex or 0-255 code by providing an argument.")
+PRINT_LAYOUTS = ("list", "grid", "compact")
+EXPORT_FORMATS = ("json", "csv")
+
+
+@lru_cache(maxsize=None)
+def _palette_escapes():
+    """Escape sequence tables of all colors: the list layout lines, grid
+    cells labeled with the color in a readable foreground, and compact cells.
+    """
+    lines, cells, blocks = [], [], []
+    for (short, rgb), (r, g, b) in zip(CLUT, _palette_rgb()):
+        lines.append(
+            "\033[48;5;%sm%s:%s\033[0m  \033[38;5;%sm%s:%s\033[0m\n"
+            % (short, short, rgb, short, short, rgb)
+        )
+        label = 16 if 299 * r + 587 * g + 114 * b > 128000 else 231
+        cells.append("\033[38;5;%d;48;5;%sm %3d " % (label, short, int(short)))
+        blocks.append("\033[48;5;%sm  " % short)
+    return lines, cells, blocks
+
+
+def _cube_rows(blocks):
+    # rows of the 6x6x6 cube, with the given blocks (red levels) side by side
+    return [
+        [16 + 36 * block + 6 * row + col for block in blocks for col in range(6)]
+        for row in range(6)
+    ]
+
+
+def format_palette(layout="list"):
+    """Format all 256 colors as a string of escape sequences.
+    @param layout: "list" of color codes and their RGB, "grid" of the
+        system colors, the 6x6x6 cube blocks and the gray ramp, or "compact",
+        the grid layout without labels
+    """
+    lines, cells, blocks = _palette_escapes()
+    if layout == "list":
+        return "".join(lines)
+    if layout == "grid":
+        rows = [range(8), range(8, 16), ()]
+        rows += _cube_rows(range(3)) + [()] + _cube_rows(range(3, 6)) + [()]
+        rows += [range(232, 244), range(244, 256)]
+    elif layout == "compact":
+        cells = blocks
+        rows = [range(16)] + _cube_rows(range(6)) + [range(232, 256)]
+    else:
+        raise ValueError("unknown layout '%s'" % layout)
+    return "".join(
+        "".join(cells[i] for i in row) + "\033[0m\n" if row else "\n" for row in rows
+    )
+
+
+def export_palette(fmt="json"):
+    """Export the color table as JSON or CSV, with code, hex and RGB values.
+    >>> print(export_palette("csv").splitlines()[17])
+    16,000000,0,0,0
+    """
+    rows = [
+        (int(short), rgb, r, g, b)
+        for (short, rgb), (r, g, b) in zip(CLUT, _palette_rgb())
+    ]
+    if fmt == "json":
+        import json
+
+        return json.dumps(
+            [
+                {"code": code, "hex": rgb, "rgb": [r, g, b]}
+                for code, rgb, r, g, b in rows
+            ],
+            indent=1,
+        ) + "\n"
+    if fmt == "csv":
+        return "code,hex,r,g,b\n" + "".join("%d,%s,%d,%d,%d\n" % row for row in rows)
+    raise ValueError("unknown format '%s'" % fmt)
+
+
+def print_all(layout="list"):
+    """Print all 256 xterm color codes, with a single write."""
+    output = format_palette(layout)
+    if layout == "list":
+        output += (
+            "Printed all codes.\n"
+            "You can translate a hex or 0-255 code by providing an argument.\n"
+        )
+    sys.stdout.write(output)
+    sys.stdout.flush()
 
 
 def rgb2short(rgb):
@@ -333,45 +1524,129 @@ def rgb2short(rgb):
     ('231', 'ffffff')
     >>> rgb2short('0DADD6') # vimeo logo
     ('38', '00afd7')
+    >>> rgb2short('#808080')
+    ('244', '808080')
     """
-    rgb = _strip_hash(rgb)
-    incs = (0x00, 0x5F, 0x87, 0xAF, 0xD7, 0xFF)
-    # Break 6-char RGB code into 3 integer vals.
-    parts = [int(h, 16) for h in re.split(r"(..)(..)(..)", rgb)[1:4]]
-    res = []
-    for part in parts:
-        i = 0
-        while i < len(incs) - 1:
-            s, b = incs[i], incs[i + 1]  # smaller, bigger
-            if s <= part <= b:
-                s1 = abs(s - part)
-                b1 = abs(b - part)
-                if s1 < b1:
-                    closest = s
-                else:
-                    closest = b
-                res.append(closest)
-                break
-            i += 1
-    # print('***', res)
-    res = "".join([("%02.x" % i) for i in res])
-    equiv = RGB2SHORT_DICT[res]
-    # print('***', res, equiv)
-    return equiv, res
+    short = rgb_int_to_short(int(_strip_hash(rgb), 16))
+    return str(short), "%06x" % short_to_rgb_int(short)
 
 
-RGB2SHORT_DICT, SHORT2RGB_DICT = _create_dicts()
+def __getattr__(name):
+    # the hex string dictionaries are only built when they're used
+    if name in ("RGB2SHORT_DICT", "SHORT2RGB_DICT"):
+        globals()["RGB2SHORT_DICT"], globals()["SHORT2RGB_DICT"] = _create_dicts()
+        return globals()[name]
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
-# ---------------------------------------------------------------------
 
-if __name__ == "__main__":
-    import doctest
+_CUBE_INDEX, _GRAY_INDEX = _create_quantization_tables()
 
-    doctest.testmod()
-    if len(sys.argv) == 1:
+# ---------------------------------------------------------------------
+
+def main(argv=None):
+    """Run the command line interface, with the arguments in argv
+    (defaults to sys.argv[1:])."""
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv:
         print_all()
-        raise SystemExit
-    arg = sys.argv[1]
+        return 0
+    arg = argv[0]
+    if arg.startswith(("--layout", "--format")):
+        import getopt
+
+        try:
+            opts, args = getopt.getopt(argv, "", ["layout=", "format="])
+        except getopt.GetoptError as err:
+            raise SystemExit("colortrans: %s" % err)
+        opts = dict(opts)
+        try:
+            if "--format" in opts:
+                sys.stdout.write(export_palette(opts["--format"]))
+            else:
+                print_all(opts["--layout"])
+        except ValueError as err:
+            raise SystemExit("colortrans: %s" % err)
+        return 0
+    if arg == "--benchmark":
+        benchmark()
+        return 0
+    if arg == "--filter":
+        try:
+            downsample_stream(sys.stdin, sys.stdout.buffer)
+        except (KeyboardInterrupt, BrokenPipeError):
+            pass
+        return 0
+    if arg == "--render":
+        import getopt
+        import shutil
+
+        try:
+            opts, args = getopt.getopt(
+                argv[1:], "d:w:h:s:", ["dither=", "width=", "height=", "size="]
+            )
+        except getopt.GetoptError as err:
+            raise SystemExit("colortrans: %s" % err)
+        opts = dict(opts)
+        columns, lines = shutil.get_terminal_size()
+        dither = opts.get("-d", opts.get("--dither", "none"))
+        max_width = int(opts.get("-w", opts.get("--width", columns)))
+        max_height = int(opts.get("-h", opts.get("--height", (lines - 1) * 2)))
+        size = opts.get("-s", opts.get("--size"))
+        if dither not in DITHERS:
+            raise SystemExit(
+                "colortrans: dither should be one of %s" % ", ".join(DITHERS)
+            )
+        try:
+            if not args or args[0] == "-":
+                render_stream(
+                    sys.stdin.buffer,
+                    sys.stdout.buffer,
+                    max_width,
+                    max_height,
+                    dither,
+                    tuple(int(n) for n in size.split("x")) if size else None,
+                )
+            else:
+                image = read_image(args[0])
+                sys.stdout.buffer.write(
+                    render_image(*image, max_width, max_height, dither)
+                )
+        except (KeyboardInterrupt, BrokenPipeError):
+            pass
+        except (OSError, ValueError) as err:
+            raise SystemExit("colortrans: %s" % err)
+        return 0
+    if arg == "--vim":
+        import getopt
+
+        try:
+            opts, args = getopt.getopt(
+                argv[1:], "m:o:f", ["metric=", "output=", "force"]
+            )
+        except getopt.GetoptError as err:
+            raise SystemExit("colortrans: %s" % err)
+        opts = dict(opts)
+        try:
+            results = compile_vim_colors(
+                args or [os.path.expanduser("~/.vim/colors")],
+                output_dir=opts.get("-o", opts.get("--output")),
+                metric=opts.get("-m", opts.get("--metric")),
+                force="-f" in opts or "--force" in opts,
+            )
+        except (OSError, ValueError) as err:
+            raise SystemExit("colortrans: %s" % err)
+        for path, output_path, status in results:
+            print("%s -> %s: %s" % (path, output_path, status))
+        return 0
+    metric = None
+    if arg == "--metric" and len(argv) > 2:
+        metric, arg = argv[1], argv[2]
+        if metric not in METRICS:
+            raise SystemExit(
+                "colortrans: unknown metric '%s', should be one of %s"
+                % (metric, ", ".join(METRICS))
+            )
     if len(arg) < 4 and int(arg) < 256:
         rgb = short2rgb(arg)
         sys.stdout.write(
@@ -379,6 +1654,17 @@ if __name__ == "__main__":
             % (arg, arg, arg, rgb)
         )
         sys.stdout.write("\033[0m\n")
+    elif metric is not None:
+        value = int(_strip_hash(arg), 16)
+        short = str(
+            rgb2short_metric(value >> 16, (value >> 8) & 0xFF, value & 0xFF, metric)
+        )
+        rgb = short2rgb(short)
+        sys.stdout.write(
+            "RGB %s -> xterm color approx \033[38;5;%sm%s (%s) by %s"
+            % (arg, short, short, rgb, metric)
+        )
+        sys.stdout.write("\033[0m\n")
     else:
         short, rgb = rgb2short(arg)
         sys.stdout.write(
@@ -386,3 +1672,8 @@ if __name__ == "__main__":
             % (arg, short, short, rgb)
         )
         sys.stdout.write("\033[0m\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
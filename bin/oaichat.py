@@ -28,18 +28,42 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 
 """
+from __future__ import annotations
+
 import sys
 import os
-import platform
-from time import time
-from typing import List, Dict, Optional, Callable
-from datetime import date
-from argparse import Namespace, ArgumentParser
-from functools import partial
+import re
+import random
+from time import time, sleep
+from typing import (
+    List,
+    Dict,
+    Tuple,
+    Optional,
+    Callable,
+    TextIO,
+    Any,
+    Deque,
+    TYPE_CHECKING,
+)
+from collections import deque, OrderedDict
+from datetime import date, datetime
+from argparse import Namespace, ArgumentParser, BooleanOptionalAction
 import json
 import logging
-import httpx  # type: ignore
-from openai import OpenAI, APIError  # type: ignore
+import tempfile
+import hashlib
+import threading
+import socket
+
+# httpx and openai are slow to import, so they're imported by the functions
+# using them, only when a request is sent (see benchmark_startup). So are the
+# modules of the batch mode, the cache, the session index and the daemon.
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+    import httpx  # type: ignore
+    import openai  # type: ignore
+    from openai import OpenAI  # type: ignore
 
 
 __VERSION__ = "1.1.2"
@@ -54,10 +78,17 @@ Type the messages to the standard input after program starts, or send a
 file to standard input: "cat question | {prog} --session quest".
 Or use prelude to provide context for the first message.
 "cat question | {prog} 'explain each line of the text below'".
+Use --list-sessions to list saved sessions, and --search to find sessions
+by their messages (full text search, see SQLite FTS5 query syntax).
+Use --daemon to keep a warm client running behind a Unix socket, and --connect
+to send a message through it: "cat question | {prog} --connect --session quest".
+Use --batch to send many independent prompts concurrently, one JSON per line
+({{"prompt": "..."}}, {{"messages": [...]}} or a string, with an optional "id"),
+responses are written to standard output as JSON lines.
 
 Environment variables: OPENAI_API_KEY (OpenAI API key),
     OAICHAT_MODEL (default chat model to use),
-    OAICHAT_DATA_PATH (path to store chat sessions),
+    OAICHAT_DATA_PATH (path to store chat sessions and the response cache),
     DEFAULT_SYSTEM_PROMPT (default system prompt),
     http_proxy, https_proxy
 """
@@ -77,6 +108,23 @@ CHAT_MODELS = (
     "gpt-3.5-turbo-0613",
     "gpt-3.5-turbo-16k-0613",
 )
+# context window size (tokens) of each chat model
+CHAT_MODELS_CONTEXT_TOKENS = {
+    "gpt-4o-mini": 128000,
+    "gpt-4o": 128000,
+    "gpt-4": 8192,
+    "gpt-4-0613": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-32k-0613": 32768,
+    "gpt-3.5-turbo": 16385,
+    "gpt-3.5-turbo-16k": 16385,
+    "gpt-3.5-turbo-1106": 16385,
+    "gpt-3.5-turbo-0613": 4096,
+    "gpt-3.5-turbo-16k-0613": 16385,
+}
+DEFAULT_CONTEXT_TOKENS = 4096  # for models not in the list above
+RESPONSE_RESERVED_TOKENS = 1024  # keep room in the context for the response
+MESSAGE_OVERHEAD_TOKENS = 4  # tokens used by the message format, per message
 DEFAULT_CHAT_MODEL = str(os.environ.get("OAICHAT_MODEL", "gpt-3.5-turbo"))
 DEFAULT_SYSTEM_PROMPT = str(
     os.environ.get(
@@ -90,6 +138,25 @@ DEFAULT_SYSTEM_PROMPT = str(
 )
 
 COMMANDS_QUIT = (":q", "quit")
+SESSION_FORMAT_VERSION = 2
+SESSION_FSYNC_EVERY = 8  # number of appended messages between fsync calls
+SESSION_INDEX_POSITION_BITS = 20  # message position bits in session index rows
+SEARCH_RESULTS_LIMIT = 20
+DAEMON_SESSIONS_CACHED = 16  # idle sessions kept open in memory by the daemon
+DEFAULT_BATCH_JOBS = 8
+DEFAULT_RETRIES = 5
+RETRY_BACKOFF_BASE = 0.5  # seconds
+RETRY_BACKOFF_MAX = 60.0  # seconds
+RATE_LIMIT_WINDOW = 60.0  # seconds, OpenAI rate limits are per minute
+HTTP_POOL_CONNECTIONS = 10  # minimum size of the HTTP keep-alive connection pool
+HTTP_KEEPALIVE_EXPIRY = 60.0  # seconds
+DEFAULT_CACHE_TTL = 7 * 24 * 3600  # seconds
+DEFAULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+CACHE_BUSY_TIMEOUT = 30.0  # seconds to wait for other processes writing the cache
+# modules that should not be imported when no request is sent
+DEFERRED_MODULES = ("openai", "httpx", "concurrent", "sqlite3", "socketserver")
+STARTUP_IMPORT_TARGET = 0.1  # seconds, imports of a run that sends no request
+STARTUP_BENCHMARK_RUNS = 5
 DATA_PATH = str(os.environ.get("OAICHAT_DATA_PATH", "~/.config/oaichat"))
 
 logger = logging.getLogger()
@@ -106,46 +173,1016 @@ ChatHistoryType = List[ChatMessageType]
 ChatCallbackType = Callable[[ChatHistoryType], None]
 
 
+class ContextWindow:
+    """Keep the chat messages sent to the model within a token budget.
+
+    Token counts are cached per message (messages are not changed once
+    added to the history), so each turn only counts the new messages.
+    Oldest messages are dropped first when the history does not fit the
+    budget. Safe to share between threads.
+
+    >>> class CharWindow(ContextWindow):  # a token per character
+    ...     def count_tokens(self, text):
+    ...         return len(text)
+    >>> window = CharWindow("gpt-4", budget=len(DEFAULT_SYSTEM_PROMPT) + 10)
+    >>> chat_history = [
+    ...     {"role": role, "content": content}
+    ...     for role, content in zip(
+    ...         ("user", "assistant") * 3, ("aaaa", "bbbb", "cc", "ddd", "e")
+    ...     )
+    ... ]
+    >>> [message["content"] for message in window.fit(chat_history)]
+    ['cc', 'ddd', 'e']
+    >>> chat_history[-1] = {"role": "user", "content": "e" * 20}  # over the budget
+    >>> [message["content"] for message in window.fit(chat_history)]
+    ['eeeeeeeeeeeeeeeeeeee']
+    """
+
+    def __init__(self, model: str, budget: Optional[int] = None):
+        if budget is None:
+            budget = (
+                CHAT_MODELS_CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS)
+                - RESPONSE_RESERVED_TOKENS
+            )
+        self.model = model
+        self.budget = budget
+        self._encoding = None
+        try:
+            import tiktoken  # type: ignore
+        except ImportError:  # token counts are estimated without tiktoken
+            tiktoken = None
+        if tiktoken is not None:
+            try:
+                self._encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                self._encoding = tiktoken.get_encoding("cl100k_base")
+        self._messages: ChatHistoryType = []  # messages with cached counts
+        self._counts: List[int] = []
+        self._lock = threading.Lock()  # guards the cached counts
+        self._system_tokens = self.count_tokens(DEFAULT_SYSTEM_PROMPT)
+
+    def count_tokens(self, text: str) -> int:
+        if self._encoding is None:  # rough estimate for English text
+            return len(text) // 4 + MESSAGE_OVERHEAD_TOKENS
+        return len(self._encoding.encode(text)) + MESSAGE_OVERHEAD_TOKENS
+
+    def _update_counts(self, chat_history: ChatHistoryType) -> None:
+        cached = min(len(self._messages), len(chat_history))
+        for i in range(cached):
+            if self._messages[i] is not chat_history[i]:
+                cached = i
+                break
+        del self._messages[cached:]
+        del self._counts[cached:]
+        for message in chat_history[cached:]:
+            self._messages.append(message)
+            self._counts.append(self.count_tokens(message.get("content", "")))
+
+    def fit(self, chat_history: ChatHistoryType) -> ChatHistoryType:
+        """Return the most recent messages of the history that fit the budget."""
+        with self._lock:
+            self._update_counts(chat_history)
+            available = self.budget - self._system_tokens
+            start = len(chat_history)
+            while start > 0 and self._counts[start - 1] <= available:
+                start -= 1
+                available -= self._counts[start]
+        if start == len(chat_history) and chat_history:
+            start -= 1  # always send the latest message, let the API complain
+        # avoid starting the conversation with a response
+        while start < len(chat_history) - 1 and chat_history[start]["role"] != "user":
+            start += 1
+        if start > 0:
+            logger.info(
+                "dropped {} old chat history items to fit {} tokens".format(
+                    start, self.budget
+                )
+            )
+        return chat_history[start:]
+
+
+class CacheMissError(Exception):
+    """Raised when a response is required from the cache but is not found."""
+
+
+class ResponseCache:
+    """On disk cache of chat responses, keyed on the model, system prompt
+    and the messages sent.
+
+    Entries expire after ttl seconds, and the least recently used entries
+    are evicted when the cache grows over max_bytes. If only is True,
+    missing entries raise CacheMissError instead of returning None.
+    The cache is shared by concurrent processes, when it's not available
+    (e.g. locked for too long) responses are not cached.
+
+    >>> path = os.path.join(tempfile.mkdtemp(), "responses.db")
+    >>> cache = ResponseCache(path, ttl=60, max_bytes=10)
+    >>> key = ResponseCache.make_key("gpt-4o", [{"role": "user", "content": "hi"}])
+    >>> key == ResponseCache.make_key("gpt-4o", [{"content": "hi", "role": "user"}])
+    True
+    >>> key == ResponseCache.make_key("gpt-4", [{"role": "user", "content": "hi"}])
+    False
+    >>> cache.put(key, "hello")
+    >>> cache.get(key)
+    'hello'
+    >>> _ = cache._db.execute("UPDATE responses SET created = created - 60")
+    >>> print(cache.get(key))  # expired
+    None
+    >>> cache.put("a", "aaaa")
+    >>> cache.put("b", "bbbb")
+    >>> cache.get("a")  # b is now the least recently used
+    'aaaa'
+    >>> cache.put("c", "cccc")  # 12 bytes, over max_bytes
+    >>> [cache.get(key) for key in ("a", "b", "c")]
+    ['aaaa', None, 'cccc']
+    >>> cache.only = True
+    >>> cache.get("b")  # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+        ...
+    CacheMissError: response is not cached
+    >>> cache.close()
+    """
+
+    def __init__(
+        self,
+        file_path: str,
+        ttl: int = DEFAULT_CACHE_TTL,
+        max_bytes: int = DEFAULT_CACHE_MAX_BYTES,
+        only: bool = False,
+    ):
+        import sqlite3
+
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.only = only
+        self._lock = threading.Lock()  # shared by batch threads
+        self._db = sqlite3.connect(
+            file_path, timeout=CACHE_BUSY_TIMEOUT, check_same_thread=False
+        )
+        # readers don't wait for writers, writers wait for each other
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, "
+            "created INTEGER, accessed REAL, size INTEGER, response TEXT)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)"
+        )
+        self._db.commit()
+
+    @staticmethod
+    def make_key(model: str, chat_history: ChatHistoryType) -> str:
+        data = json.dumps(
+            [model, DEFAULT_SYSTEM_PROMPT, chat_history],
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        import sqlite3
+
+        now = time()
+        row = None
+        with self._lock:
+            try:
+                row = self._db.execute(
+                    "SELECT response FROM responses WHERE key = ? AND created > ?",
+                    (key, int(now) - self.ttl),
+                ).fetchone()
+                if row is not None:
+                    self._db.execute(
+                        "UPDATE responses SET accessed = ? WHERE key = ?", (now, key)
+                    )
+                    self._db.commit()
+            except sqlite3.Error as err:
+                self._db.rollback()
+                logger.warning("response cache is not available: {}".format(err))
+        if row is None:
+            if self.only:
+                raise CacheMissError("response is not cached")
+            return None
+        return row[0]
+
+    def put(self, key: str, response: str) -> None:
+        import sqlite3
+
+        now = time()
+        size = len(response.encode("utf-8"))
+        with self._lock:
+            try:
+                self._put(key, response, size, now)
+            except sqlite3.Error as err:
+                self._db.rollback()
+                logger.warning("response is not cached: {}".format(err))
+
+    def _put(self, key: str, response: str, size: int, now: float) -> None:
+        self._db.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+            (key, int(now), now, size, response),
+        )
+        self._db.execute(
+            "DELETE FROM responses WHERE created <= ?", (int(now) - self.ttl,)
+        )
+        total = self._db.execute("SELECT SUM(size) FROM responses").fetchone()[0]
+        if total > self.max_bytes:
+            evicted = 0
+            for old_key, old_size in self._db.execute(
+                "SELECT key, size FROM responses ORDER BY accessed"
+            ).fetchall():
+                if total <= self.max_bytes:
+                    break
+                self._db.execute("DELETE FROM responses WHERE key = ?", (old_key,))
+                total -= old_size
+                evicted += 1
+            logger.debug("evicted {} cached responses".format(evicted))
+        self._db.commit()
+
+    def close(self) -> None:
+        self._db.close()
+
+
+def parse_rate_limit_duration(value: str) -> float:
+    """Parse rate limit reset durations like '1s', '6m0s' or '20ms' to seconds.
+
+    >>> [parse_rate_limit_duration(value) for value in ("6m0s", "20ms", "1.5")]
+    [360.0, 0.02, 1.5]
+    """
+    units = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts:
+        return float(value)
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+
+class TokenBucket:
+    """Token bucket refilled at a constant rate up to its capacity.
+
+    Capacity and the current level are updated from the rate limit
+    response headers.
+
+    >>> bucket = TokenBucket()
+    >>> bucket.reserve(100)  # the limit is not known yet
+    0.0
+    >>> bucket.update(limit="60", remaining="1", reset="59s")
+    >>> bucket.reserve(1)
+    0.0
+    >>> round(bucket.reserve(1), 1)  # empty, refilled by a token per second
+    1.0
+    >>> round(bucket.reserve(1000), 1)  # a reservation is at most the capacity
+    61.0
+    """
+
+    def __init__(self):
+        self.capacity = 0.0  # 0 means the limit is not known yet
+        self.level = 0.0
+        self.rate = 0.0
+        self.updated = time()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, cost: float) -> float:
+        """Take cost from the bucket, return seconds to wait before using it."""
+        if not self.capacity:
+            return 0.0
+        now = time()
+        self._refill(now)
+        self.level -= min(cost, self.capacity)
+        if self.level >= 0:
+            return 0.0
+        return -self.level / self.rate
+
+    def update(self, limit: str, remaining: str, reset: str) -> None:
+        try:
+            capacity = float(limit)
+            level = float(remaining)
+            reset_after = parse_rate_limit_duration(reset) if reset else 0.0
+        except ValueError:
+            return
+        self.capacity = capacity
+        self.rate = capacity / RATE_LIMIT_WINDOW
+        if reset_after > 0:  # the server knows better when the bucket is full
+            self.rate = max(self.rate, (capacity - level) / reset_after)
+        self.level = level
+        self.updated = time()
+
+
+class RequestScheduler:
+    """Pace API requests to stay within the rate limits and retry failures.
+
+    Request and token rates are learned from the x-ratelimit-* response
+    headers. Rate limited (429), server (5xx) and connection errors are
+    retried with jittered exponential backoff, or after the delay asked
+    by the server.
+    """
+
+    def __init__(self, retries: int = DEFAULT_RETRIES):
+        self.retries = retries
+        self._lock = threading.Lock()
+        self._requests = TokenBucket()
+        self._tokens = TokenBucket()
+
+    def _acquire(self, tokens: float) -> None:
+        with self._lock:
+            delay = max(self._requests.reserve(1), self._tokens.reserve(tokens))
+        if delay > 0:
+            logger.info("waiting {:.3f}s for the rate limit".format(delay))
+            sleep(delay)
+
+    def _update(self, headers: Any) -> None:
+        if headers is None:
+            return
+        with self._lock:
+            buckets = (("requests", self._requests), ("tokens", self._tokens))
+            for name, bucket in buckets:
+                limit = headers.get("x-ratelimit-limit-" + name)
+                remaining = headers.get("x-ratelimit-remaining-" + name)
+                if limit is not None and remaining is not None:
+                    reset = headers.get("x-ratelimit-reset-" + name, "")
+                    bucket.update(limit, remaining, reset)
+
+    def _backoff(self, attempt: int, err: openai.APIError) -> float:
+        response = getattr(err, "response", None)
+        if response is not None:
+            retry_after = response.headers.get("retry-after")
+            if retry_after:
+                try:
+                    return min(float(retry_after), RETRY_BACKOFF_MAX)
+                except ValueError:
+                    pass
+        backoff = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2**attempt)
+        return random.uniform(0, backoff)
+
+    @staticmethod
+    def _should_retry(err: openai.APIError) -> bool:
+        import openai  # type: ignore  # noqa: F811
+
+        if isinstance(err, (openai.RateLimitError, openai.APIConnectionError)):
+            return True
+        return isinstance(err, openai.APIStatusError) and err.status_code >= 500
+
+    def create_chat_completion(self, client: OpenAI, **kwargs: Any) -> Any:
+        """Create a chat completion, waiting for the rate limits and retrying
+        on transient errors."""
+        import openai  # type: ignore  # noqa: F811
+
+        messages = kwargs.get("messages", [])
+        tokens = sum(len(message.get("content", "")) for message in messages) / 4
+        attempt = 0
+        while True:
+            self._acquire(tokens)
+            try:
+                raw_response = client.chat.completions.with_raw_response.create(
+                    **kwargs
+                )
+            except openai.APIError as err:
+                response = getattr(err, "response", None)
+                self._update(getattr(response, "headers", None))
+                if attempt >= self.retries or not self._should_retry(err):
+                    raise
+                delay = self._backoff(attempt, err)
+                attempt += 1
+                logger.info(
+                    "request failed ({}), retry {} of {} in {:.3f}s".format(
+                        err, attempt, self.retries, delay
+                    )
+                )
+                sleep(delay)
+                continue
+            self._update(raw_response.headers)
+            return raw_response.parse()
+
+
+def create_chat_completion(
+    client: OpenAI, scheduler: Optional[RequestScheduler], **kwargs: Any
+) -> Any:
+    """Create a chat completion, through the scheduler if there is one."""
+    if scheduler is None:
+        return client.chat.completions.create(**kwargs)
+    return scheduler.create_chat_completion(client, **kwargs)
+
+
+class ChatMetrics:
+    """Collect timing and token usage of the requests and session saves.
+
+    Records are kept for the summary, and appended to a JSON lines file
+    if a file path is given. HTTP connect time and time to first byte
+    are collected by tracing the requests of the HTTP client.
+    """
+
+    def __init__(self, file_path: Optional[str] = None):
+        self.records: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()  # trace of the last request per thread
+        self._file = None
+        if file_path:
+            self._file = open(file_path, "a", encoding="utf-8")
+
+    def trace_request(self, request: Any) -> None:
+        """HTTP client request hook, trace connection and response events."""
+        trace = {"start": time()}
+        self._local.trace = trace
+
+        def on_event(name: str, info: Any) -> None:
+            if name == "connection.connect_tcp.started":
+                trace["connect_started"] = time()
+            elif name in (
+                "connection.connect_tcp.complete",
+                "connection.start_tls.complete",
+            ):
+                trace["connected"] = time()
+            elif name.endswith(".receive_response_headers.complete"):
+                trace["first_byte"] = time()
+
+        request.extensions["trace"] = on_event
+
+    def request_timings(self) -> Dict[str, float]:
+        """Return connect and time to first byte of the last traced request
+        of the current thread."""
+        trace = getattr(self._local, "trace", None)
+        if trace is None:
+            return {}
+        timings = {"connect": 0.0}  # 0 for a reused keep-alive connection
+        if "connect_started" in trace and "connected" in trace:
+            timings["connect"] = trace["connected"] - trace["connect_started"]
+        if "first_byte" in trace:
+            timings["ttfb"] = trace["first_byte"] - trace["start"]
+        return timings
+
+    def record(self, event: str, **values: Any) -> None:
+        record = {"event": event, "timestamp": round(time(), 3)}
+        for key, value in values.items():
+            record[key] = round(value, 4) if isinstance(value, float) else value
+        with self._lock:
+            self.records.append(record)
+            if self._file is not None:
+                self._file.write(json.dumps(record) + "\n")
+                self._file.flush()
+
+    def summary(self) -> str:
+        requests = [r for r in self.records if r["event"] == "request"]
+        saves = [r for r in self.records if r["event"] == "save"]
+        cache_hits = sum(1 for r in self.records if r["event"] == "cache_hit")
+        lines = [
+            "requests: {}, cached responses: {}, tokens: prompt {}, "
+            "completion {}".format(
+                len(requests),
+                cache_hits,
+                sum(r.get("prompt_tokens") or 0 for r in requests),
+                sum(r.get("completion_tokens") or 0 for r in requests),
+            )
+        ]
+        series = [
+            ("connect", requests),
+            ("ttfb", requests),
+            ("first_token", requests),
+            ("total", requests),
+            ("elapsed", saves),
+        ]
+        for name, records in series:
+            values = sorted(r[name] for r in records if r.get(name) is not None)
+            if not values:
+                continue
+            lines.append(
+                "{:<12} mean {:.3f}s  p50 {:.3f}s  p95 {:.3f}s  max {:.3f}s".format(
+                    "save" if name == "elapsed" else name,
+                    sum(values) / len(values),
+                    values[len(values) // 2],
+                    values[min(len(values) - 1, int(len(values) * 0.95))],
+                    values[-1],
+                )
+            )
+        if requests:
+            lines.append(
+                "history size: last {} bytes, max {} bytes".format(
+                    requests[-1]["history_bytes"],
+                    max(r["history_bytes"] for r in requests),
+                )
+            )
+        return "\n".join(lines)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def record_request_metrics(
+    metrics: ChatMetrics,
+    model: str,
+    messages: ChatHistoryType,
+    started: float,
+    usage: Any,
+    **values: Any,
+) -> None:
+    """Record the metrics of a completed chat completion request."""
+    metrics.record(
+        "request",
+        model=model,
+        history_items=len(messages),
+        history_bytes=len(json.dumps(messages).encode("utf-8")),
+        total=time() - started,
+        prompt_tokens=getattr(usage, "prompt_tokens", None),
+        completion_tokens=getattr(usage, "completion_tokens", None),
+        **metrics.request_timings(),
+        **values,
+    )
+
+
+def make_request_messages(chat_history: ChatHistoryType) -> ChatHistoryType:
+    """Return the list of messages to send, prefixed with the system prompt."""
+    return [
+        {
+            "role": "system",
+            "content": DEFAULT_SYSTEM_PROMPT,
+        }
+    ] + chat_history
+
+
 def send_chat_message(
     client: OpenAI,
     model: str,
     chat_history: ChatHistoryType,
+    scheduler: Optional[RequestScheduler] = None,
+    metrics: Optional[ChatMetrics] = None,
 ) -> str:
     """Send a chat message to OpenAI API and return the response."""
     logger.debug("sending {} chat history items".format(len(chat_history)))
     logger.debug("system prompt: {}".format(DEFAULT_SYSTEM_PROMPT))
-    response = client.chat.completions.create(
-        messages=[
-            {
-                "role": "system",
-                "content": DEFAULT_SYSTEM_PROMPT,
-            }
-        ]
-        + chat_history,
+    messages = make_request_messages(chat_history)
+    started = time()
+    response = create_chat_completion(
+        client,
+        scheduler,
+        messages=messages,
         model=model,
     )
     logger.debug("received response. choices {}".format(len(response.choices)))
+    if metrics is not None:
+        record_request_metrics(
+            metrics, model, messages, started, getattr(response, "usage", None)
+        )
     choice = response.choices[0]
     return choice.message.content.strip()
 
 
+def stream_chat_message(
+    client: OpenAI,
+    model: str,
+    chat_history: ChatHistoryType,
+    output: TextIO = sys.stdout,
+    scheduler: Optional[RequestScheduler] = None,
+    metrics: Optional[ChatMetrics] = None,
+) -> str:
+    """Send a chat message to OpenAI API, write the response to output
+    as it arrives, and return the whole response."""
+    logger.debug("streaming {} chat history items".format(len(chat_history)))
+    logger.debug("system prompt: {}".format(DEFAULT_SYSTEM_PROMPT))
+    started = time()
+    first_token_at = None
+    chunks = 0
+    parts = []
+    usage = None
+    messages = make_request_messages(chat_history)
+    extra_kwargs: Dict[str, Any] = {}
+    if metrics is not None:  # token usage is sent in the last chunk
+        extra_kwargs["stream_options"] = {"include_usage": True}
+    stream = create_chat_completion(
+        client,
+        scheduler,
+        messages=messages,
+        model=model,
+        stream=True,
+        **extra_kwargs,
+    )
+    for chunk in stream:
+        if getattr(chunk, "usage", None) is not None:
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            continue
+        if not parts:  # skip leading white space, same as the stripped response
+            delta = delta.lstrip()
+            if not delta:
+                continue
+            first_token_at = time()
+        chunks += 1
+        parts.append(delta)
+        output.write(delta)
+        output.flush()
+    finished = time()
+    output.write("\n")
+    if metrics is not None:
+        record_request_metrics(
+            metrics,
+            model,
+            messages,
+            started,
+            usage,
+            first_token=None if first_token_at is None else first_token_at - started,
+        )
+    if first_token_at is not None:
+        generation_time = finished - first_token_at
+        logger.info(
+            "time to first token {:.3f}s, {} tokens in {:.3f}s "
+            "({:.1f} tokens/s)".format(
+                first_token_at - started,
+                chunks,
+                finished - started,
+                chunks / generation_time if generation_time > 0 else 0.0,
+            )
+        )
+    return "".join(parts).strip()
+
+
 def load_chat_history(file_path: str) -> ChatHistoryType:
-    """Load chat history from a file."""
+    """Load chat history from a file.
+
+    Reads both the append only log (format version 2), one message per line,
+    and the legacy single JSON document (format version 1).
+    """
+    chat_history = []
     with open(file_path, "r", encoding="utf-8") as file:
-        saved_data = json.load(file)
-    return saved_data.get("chat_history", [])
+        try:
+            header = json.loads(file.readline())
+        except ValueError:  # a legacy document that spans multiple lines
+            header = None
+        if not isinstance(header, dict):
+            file.seek(0)
+            header = json.load(file)
+        if header.get("format_version") != SESSION_FORMAT_VERSION:
+            return header.get("chat_history", [])
+        for line in file:
+            try:
+                chat_history.append(json.loads(line))
+            except ValueError:  # a torn write from an interrupted session
+                logger.warning("ignoring incomplete record in {}".format(file_path))
+                break
+    return chat_history
 
 
-def save_chat_history(file_path: str, chat_history: ChatHistoryType) -> None:
-    """Save chat history to a file."""
-    saved_data = {
-        "format_verion": 1,
-        "prog_verion": __VERSION__,
+def is_session_log(file_path: str) -> bool:
+    """Return True if the file is an append only log (format version 2)
+    ending with a complete record, so new messages can be appended to it."""
+    with open(file_path, "rb") as file:
+        try:
+            header = json.loads(file.readline())
+        except ValueError:
+            return False
+        if not isinstance(header, dict):
+            return False
+        if header.get("format_version") != SESSION_FORMAT_VERSION:
+            return False
+        file.seek(-1, os.SEEK_END)
+        return file.read(1) == b"\n"
+
+
+def _session_header() -> str:
+    header = {
+        "format_version": SESSION_FORMAT_VERSION,
+        "prog_version": __VERSION__,
         "timestamp": int(time()),
-        "chat_history": chat_history,
     }
-    with open(file_path, "w", encoding="utf-8") as file:
-        json.dump(saved_data, file)
+    return json.dumps(header) + "\n"
+
+
+def save_chat_history(file_path: str, chat_history: ChatHistoryType) -> None:
+    """Save the whole chat history to a file, replacing it atomically."""
+    dir_name = os.path.dirname(os.path.abspath(file_path))
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=".{}.".format(os.path.basename(file_path)), dir=dir_name
+    )
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            file.write(_session_header())
+            for message in chat_history:
+                file.write(json.dumps(message) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class SessionIndex:
+    """Catalog and full text search index of the saved sessions.
+
+    Messages are stored in an SQLite FTS5 table. Each row id is made of the
+    session id and the message position, so messages of a session can be
+    replaced without scanning the whole table.
+
+    >>> session_dir = tempfile.mkdtemp()
+    >>> for name, content in (("fruits", "apples and pears"), ("pets", "cats")):
+    ...     save_chat_history(
+    ...         os.path.join(session_dir, name + ".json"),
+    ...         [{"role": "user", "content": content}],
+    ...     )
+    >>> index = SessionIndex(os.path.join(session_dir, "sessions.db"))
+    >>> index.sync(session_dir)
+    >>> index.search("apples")
+    [('fruits', 0, 'user', '[apples] and pears')]
+    >>> with open(os.path.join(session_dir, "pets.json"), "a") as log:
+    ...     _ = log.write('{"role": "assistant", "content": "dogs and cats"}\\n')
+    >>> replace_session = index.replace_session
+    >>> def replace_changed(name, chat_history, stat):
+    ...     print("indexing", name)
+    ...     replace_session(name, chat_history, stat)
+    >>> index.replace_session = replace_changed
+    >>> index.sync(session_dir)  # only the changed session
+    indexing pets
+    >>> [(name, messages) for name, _, _, messages in index.list_sessions("size")]
+    [('pets', 2), ('fruits', 1)]
+    >>> index.search("cats")  # best match first
+    [('pets', 0, 'user', '[cats]'), ('pets', 1, 'assistant', 'dogs and [cats]')]
+    >>> index.search("pears AND")  # not a valid query, searched as a phrase
+    []
+    >>> index.close()
+    """
+
+    def __init__(self, file_path: str):
+        import sqlite3
+
+        # daemon sessions are used by a handler thread at a time
+        self._db = sqlite3.connect(file_path, check_same_thread=False)
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS sessions (id INTEGER PRIMARY KEY, "
+            "name TEXT UNIQUE, mtime REAL, size INTEGER, messages INTEGER);"
+            "CREATE VIRTUAL TABLE IF NOT EXISTS session_messages "
+            "USING fts5(role UNINDEXED, content);"
+        )
+        self._db.commit()
+
+    @staticmethod
+    def session_name(file_path: str) -> str:
+        return os.path.splitext(os.path.basename(file_path))[0]
+
+    def _session_id(self, name: str) -> int:
+        row = self._db.execute(
+            "SELECT id FROM sessions WHERE name = ?", (name,)
+        ).fetchone()
+        if row is not None:
+            return row[0]
+        cursor = self._db.execute(
+            "INSERT INTO sessions (name, mtime, size, messages) VALUES (?, 0, 0, 0)",
+            (name,),
+        )
+        return int(cursor.lastrowid)
+
+    def _insert(self, session_id: int, position: int, messages: ChatHistoryType):
+        base = session_id << SESSION_INDEX_POSITION_BITS
+        self._db.executemany(
+            "INSERT INTO session_messages (rowid, role, content) VALUES (?, ?, ?)",
+            [
+                (base + position + i, message.get("role"), message.get("content"))
+                for i, message in enumerate(messages)
+            ],
+        )
+
+    def _delete(self, session_id: int) -> None:
+        base = session_id << SESSION_INDEX_POSITION_BITS
+        self._db.execute(
+            "DELETE FROM session_messages WHERE rowid >= ? AND rowid < ?",
+            (base, base + (1 << SESSION_INDEX_POSITION_BITS)),
+        )
+
+    def is_current(self, name: str, stat: os.stat_result) -> bool:
+        """Return True if the session is indexed at the size and mtime of stat."""
+        row = self._db.execute(
+            "SELECT mtime, size FROM sessions WHERE name = ?", (name,)
+        ).fetchone()
+        return row is not None and tuple(row) == (stat.st_mtime, stat.st_size)
+
+    def replace_session(
+        self, name: str, chat_history: ChatHistoryType, stat: os.stat_result
+    ) -> None:
+        """Index all the messages of a session, replacing the indexed ones."""
+        session_id = self._session_id(name)
+        self._delete(session_id)
+        self._insert(session_id, 0, chat_history)
+        self._db.execute(
+            "UPDATE sessions SET mtime = ?, size = ?, messages = ? WHERE id = ?",
+            (stat.st_mtime, stat.st_size, len(chat_history), session_id),
+        )
+        self._db.commit()
+
+    def append_messages(
+        self,
+        name: str,
+        position: int,
+        messages: ChatHistoryType,
+        stat: os.stat_result,
+    ) -> None:
+        """Index messages appended to a session at the position."""
+        session_id = self._session_id(name)
+        self._insert(session_id, position, messages)
+        self._db.execute(
+            "UPDATE sessions SET mtime = ?, size = ?, messages = ? WHERE id = ?",
+            (stat.st_mtime, stat.st_size, position + len(messages), session_id),
+        )
+        self._db.commit()
+
+    def sync(self, session_dir: str) -> None:
+        """Index sessions changed outside of the index (by size and mtime)
+        and remove the deleted ones."""
+        indexed = {
+            name: (session_id, mtime, size)
+            for session_id, name, mtime, size in self._db.execute(
+                "SELECT id, name, mtime, size FROM sessions"
+            )
+        }
+        for entry in os.scandir(session_dir):
+            if not entry.name.endswith(".json") or not entry.is_file():
+                continue
+            name = self.session_name(entry.name)
+            _, mtime, size = indexed.pop(name, (None, None, None))
+            stat = entry.stat()
+            if (mtime, size) == (stat.st_mtime, stat.st_size):
+                continue
+            try:
+                chat_history = load_chat_history(entry.path)
+            except (OSError, ValueError) as err:
+                logger.warning("failed to index session {}: {}".format(name, err))
+                continue
+            self.replace_session(name, chat_history, stat)
+        for session_id, _, _ in indexed.values():
+            self._delete(session_id)
+            self._db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+        self._db.commit()
+
+    def list_sessions(self, order: str = "recent") -> List[tuple]:
+        """Return name, mtime, size and messages count of the sessions,
+        the most recent or the largest first."""
+        column = "size" if order == "size" else "mtime"
+        return self._db.execute(
+            "SELECT name, mtime, size, messages FROM sessions "
+            "ORDER BY {} DESC".format(column)
+        ).fetchall()
+
+    def search(self, query: str, limit: int = SEARCH_RESULTS_LIMIT) -> List[tuple]:
+        """Return session name, message position, role and a snippet
+        of the best matching messages."""
+        import sqlite3
+
+        sql = (
+            "SELECT sessions.name, session_messages.rowid & ?, session_messages.role, "
+            "snippet(session_messages, 1, '[', ']', '...', 12) "
+            "FROM session_messages "
+            "JOIN sessions ON sessions.id = session_messages.rowid >> ? "
+            "WHERE session_messages MATCH ? ORDER BY rank LIMIT ?"
+        )
+        mask = (1 << SESSION_INDEX_POSITION_BITS) - 1
+        try:
+            return self._db.execute(
+                sql, (mask, SESSION_INDEX_POSITION_BITS, query, limit)
+            ).fetchall()
+        except sqlite3.OperationalError:  # not a valid FTS query, match as phrase
+            phrase = '"{}"'.format(query.replace('"', '""'))
+            return self._db.execute(
+                sql, (mask, SESSION_INDEX_POSITION_BITS, phrase, limit)
+            ).fetchall()
+
+    def close(self) -> None:
+        self._db.close()
+
+
+class ChatHistoryLog:
+    """Chat callback that appends new messages to a session log.
+
+    The first call compacts the whole history into the file (converting
+    legacy files), later calls only append the new messages. If saved is
+    set, the file is already a log of that many messages of the history
+    (see is_session_log), and the first call appends to it too. Writes are
+    synced to disk every fsync_every records, or on close.
+    If index is set, saved messages are added to the session index.
+
+    >>> path = os.path.join(tempfile.mkdtemp(), "session.json")
+    >>> with open(path, "w") as legacy:  # format version 1
+    ...     json.dump({"chat_history": [{"role": "user", "content": "hi"}]}, legacy)
+    >>> chat_history = load_chat_history(path)
+    >>> chat_history.append({"role": "assistant", "content": "hello"})
+    >>> log = ChatHistoryLog(path)
+    >>> log(chat_history)  # compacts the legacy file into a log
+    >>> chat_history.append({"role": "user", "content": "bye"})
+    >>> log(chat_history)  # appends the new message
+    >>> log.close()
+    >>> load_chat_history(path) == chat_history, is_session_log(path)
+    (True, True)
+    >>> chat_history.append({"role": "assistant", "content": "bye"})
+    >>> log = ChatHistoryLog(path, saved=3)
+    >>> log(chat_history)
+    >>> log.close()
+    >>> with open(path) as saved:  # the header and a line per message
+    ...     len(saved.readlines())
+    5
+    >>> load_chat_history(path) == chat_history
+    True
+    >>> with open(path, "a") as torn:  # an interrupted write
+    ...     _ = torn.write('{"role": "us')
+    >>> is_session_log(path)  # can't be appended to, it's compacted
+    False
+    """
+
+    def __init__(
+        self,
+        file_path: str,
+        fsync_every: int = SESSION_FSYNC_EVERY,
+        index: Optional[SessionIndex] = None,
+        saved: int = 0,
+    ):
+        self.file_path = file_path
+        self.fsync_every = max(1, fsync_every)
+        self.index = index
+        self._file: Optional[TextIO] = None
+        self._saved = saved  # number of messages already in the file
+        self._unsynced = 0
+
+    def __call__(self, chat_history: ChatHistoryType) -> None:
+        if not self._saved or len(chat_history) < self._saved:
+            self.close()
+            save_chat_history(self.file_path, chat_history)
+            self._file = open(self.file_path, "a", encoding="utf-8")
+            self._saved = len(chat_history)
+            if self.index is not None:
+                self.index.replace_session(
+                    SessionIndex.session_name(self.file_path),
+                    chat_history,
+                    os.fstat(self._file.fileno()),
+                )
+            return
+        if self._file is None:
+            self._file = open(self.file_path, "a", encoding="utf-8")
+        new_messages = chat_history[self._saved :]
+        for message in new_messages:
+            self._file.write(json.dumps(message) + "\n")
+            self._unsynced += 1
+        self._file.flush()
+        if self.index is not None:
+            self.index.append_messages(
+                SessionIndex.session_name(self.file_path),
+                self._saved,
+                new_messages,
+                os.fstat(self._file.fileno()),
+            )
+        self._saved = len(chat_history)
+        if self._unsynced >= self.fsync_every:
+            self.sync()
+
+    def sync(self) -> None:
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def close(self) -> None:
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+
+def open_session_log(
+    file_path: str, index: Optional[SessionIndex] = None
+) -> Tuple[ChatHistoryType, ChatHistoryLog]:
+    """Load the chat history of a session and return it with a ChatHistoryLog
+    saving its new messages.
+
+    An append only log is appended to, after indexing it again if it was
+    changed outside of the index. Other files are compacted by the first save.
+
+    >>> path = os.path.join(tempfile.mkdtemp(), "session.json")
+    >>> chat_history, log = open_session_log(path)  # a new session
+    >>> chat_history += [{"role": "user", "content": "hi"}] * 2
+    >>> log(chat_history)
+    >>> log.close()
+    >>> inode, size = os.stat(path).st_ino, os.path.getsize(path)
+    >>> chat_history, log = open_session_log(path)  # the next run of oaichat
+    >>> len(chat_history)
+    2
+    >>> chat_history.append({"role": "assistant", "content": "bye"})
+    >>> log(chat_history)
+    >>> log.close()
+    >>> os.stat(path).st_ino == inode  # not replaced by a compacted copy
+    True
+    >>> with open(path) as appended:
+    ...     _ = appended.seek(size)
+    ...     appended.read()
+    '{"role": "assistant", "content": "bye"}\\n'
+    """
+    chat_history: ChatHistoryType = []
+    saved = 0
+    if os.path.exists(file_path):
+        chat_history = load_chat_history(file_path)
+        if is_session_log(file_path):
+            saved = len(chat_history)
+        name = SessionIndex.session_name(file_path)
+        stat = os.stat(file_path)
+        if saved and index is not None and not index.is_current(name, stat):
+            index.replace_session(name, chat_history, stat)
+    return chat_history, ChatHistoryLog(file_path, index=index, saved=saved)
 
 
 def read_input() -> str:
@@ -169,8 +1206,20 @@ def start_chat(
     prelude: str = "",
     chat_history: Optional[ChatHistoryType] = None,
     callback: Optional[ChatCallbackType] = None,
+    stream: bool = False,
+    context: Optional[ContextWindow] = None,
+    cache: Optional[ResponseCache] = None,
+    scheduler: Optional[RequestScheduler] = None,
+    metrics: Optional[ChatMetrics] = None,
 ) -> ChatHistoryType:
-    """Start a chat session."""
+    """Start a chat session.
+
+    If stream is True, the response is printed as it arrives.
+    If context is set, only the recent messages fitting its budget are sent.
+    If cache is set, cached responses are used instead of sending the messages.
+    If scheduler is set, requests are paced and retried by it.
+    If metrics is set, requests and saving the history are measured.
+    """
 
     print("Press Ctrl+D (EOF) to send the message.", file=sys.stderr)
     print(
@@ -201,17 +1250,490 @@ def start_chat(
         if not is_tty:  # separate message from stdin with a blank line
             print()
         print("sending ...", file=sys.stderr)
-        response = send_chat_message(client, model, chat_history)
+        request_history = chat_history
+        if context is not None:
+            request_history = context.fit(chat_history)
+        cache_key = None
+        response = None
+        if cache is not None:
+            cache_key = cache.make_key(model, request_history)
+            response = cache.get(cache_key)
+        if response is not None:
+            logger.info("using cached response")
+            if metrics is not None:
+                metrics.record("cache_hit", model=model)
+            print(response)
+        else:
+            if stream:
+                response = stream_chat_message(
+                    client, model, request_history, sys.stdout, scheduler, metrics
+                )
+            else:
+                response = send_chat_message(
+                    client, model, request_history, scheduler, metrics
+                )
+                print(response)
+            if cache_key is not None:
+                cache.put(cache_key, response)
         chat_history.append({"role": "assistant", "content": response})
-        print(response)
         logger.debug("chat history items: {}".format(len(chat_history)))
         if callback is not None:
+            started = time()
             callback(chat_history)
+            if metrics is not None:
+                metrics.record(
+                    "save", elapsed=time() - started, history_items=len(chat_history)
+                )
     return chat_history
 
 
+def batch_request_messages(record: Any, prelude: str = "") -> ChatHistoryType:
+    """Return the chat messages to send for a batch input record."""
+    if isinstance(record, dict) and "messages" in record:
+        return list(record["messages"])
+    content = record if isinstance(record, str) else str(record["prompt"])
+    if prelude:
+        content = "{}\n{}".format(prelude, content)
+    return [{"role": "user", "content": content}]
+
+
+def send_batch_item(
+    client: OpenAI,
+    model: str,
+    index: int,
+    line: str,
+    prelude: str = "",
+    cache: Optional[ResponseCache] = None,
+    scheduler: Optional[RequestScheduler] = None,
+    metrics: Optional[ChatMetrics] = None,
+) -> Dict[str, Any]:
+    """Send a single batch input line, and return the result record."""
+    import openai  # type: ignore  # noqa: F811
+
+    result: Dict[str, Any] = {"index": index}
+    started = time()
+    try:
+        record = json.loads(line)
+        if isinstance(record, dict) and "id" in record:
+            result["id"] = record["id"]
+        messages = batch_request_messages(record, prelude)
+        response = None
+        if cache is not None:
+            cache_key = cache.make_key(model, messages)
+            response = cache.get(cache_key)
+            if response is not None and metrics is not None:
+                metrics.record("cache_hit", model=model)
+        if response is None:
+            response = send_chat_message(client, model, messages, scheduler, metrics)
+            if cache is not None:
+                cache.put(cache_key, response)
+        result["response"] = response
+    except (ValueError, KeyError, TypeError) as err:
+        result["error"] = "invalid batch input: {}".format(err)
+    except (openai.APIError, CacheMissError) as err:
+        logger.info("batch item {} failed: {}".format(index, err))
+        result["error"] = str(err)
+    result["elapsed"] = round(time() - started, 3)
+    return result
+
+
+def run_batch(
+    client: OpenAI,
+    model: str,
+    prompts: TextIO,
+    output: TextIO,
+    prelude: str = "",
+    jobs: int = DEFAULT_BATCH_JOBS,
+    ordered: bool = True,
+    cache: Optional[ResponseCache] = None,
+    scheduler: Optional[RequestScheduler] = None,
+    metrics: Optional[ChatMetrics] = None,
+) -> int:
+    """Send each line of prompts concurrently, write the results to output
+    as JSON lines, in input order or as they complete.
+
+    Returns the number of failed items.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    jobs = max(1, jobs)
+    failures = 0
+    pending: Deque[Future] = deque()
+
+    def write_done(block: bool) -> None:
+        nonlocal failures
+        if ordered:
+            done = []
+            while pending and (block or pending[0].done()):
+                done.append(pending.popleft())
+                block = False
+        else:
+            finished, _ = wait(
+                pending, timeout=None if block else 0, return_when=FIRST_COMPLETED
+            )
+            done = [future for future in pending if future in finished]
+            for future in done:
+                pending.remove(future)
+        for future in done:
+            result = future.result()
+            if "error" in result:
+                failures += 1
+            output.write(json.dumps(result) + "\n")
+        output.flush()
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        try:
+            index = 0
+            for line in prompts:
+                if not line.strip():
+                    continue
+                # bound the number of in flight items to keep memory flat
+                while len(pending) >= jobs * 2:
+                    write_done(block=True)
+                pending.append(
+                    executor.submit(
+                        send_batch_item,
+                        client,
+                        model,
+                        index,
+                        line,
+                        prelude,
+                        cache,
+                        scheduler,
+                        metrics,
+                    )
+                )
+                index += 1
+                write_done(block=False)
+            while pending:
+                write_done(block=True)
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+    logger.info("batch finished, {} items, {} failed".format(index, failures))
+    return failures
+
+
+class JsonLinesWriter:
+    """File like writer that sends each write as a JSON line message."""
+
+    def __init__(self, file: Any):
+        self.file = file
+
+    def write(self, text: str) -> int:
+        self.file.write((json.dumps({"delta": text}) + "\n").encode("utf-8"))
+        return len(text)
+
+    def flush(self) -> None:
+        self.file.flush()
+
+
+class DaemonSession:
+    """Chat history of a daemon session, kept in memory between requests.
+
+    The history is loaded again only if the session file is changed by
+    another process, new messages are appended to the file and the index.
+    Used by a request at a time, under its lock.
+    """
+
+    def __init__(self, file_path: str, index: Optional[SessionIndex] = None):
+        self.file_path = file_path
+        self.index = index
+        self.lock = threading.Lock()
+        self.users = 0  # requests using or waiting for the session
+        self.chat_history: ChatHistoryType = []
+        self.context: Optional[ContextWindow] = None
+        self._log: Optional[ChatHistoryLog] = None
+        self._file_state: Optional[tuple] = None  # (mtime, size) when saved
+
+    def _stat(self) -> Optional[os.stat_result]:
+        try:
+            return os.stat(self.file_path)
+        except FileNotFoundError:
+            return None
+
+    def load(self) -> ChatHistoryType:
+        """Return the chat history, loading it if the file has changed."""
+        stat = self._stat()
+        file_state = None if stat is None else (stat.st_mtime_ns, stat.st_size)
+        if self._log is not None and file_state == self._file_state:
+            return self.chat_history
+        self.close()
+        self.chat_history, self._log = open_session_log(self.file_path, self.index)
+        self._file_state = file_state
+        return self.chat_history
+
+    def save(self) -> None:
+        """Save the new messages of the chat history."""
+        if self._log is None:
+            raise ValueError("session is not loaded")
+        try:
+            self._log(self.chat_history)
+        except BaseException:
+            self.close()  # load the history from the file again
+            raise
+        stat = os.stat(self.file_path)
+        self._file_state = (stat.st_mtime_ns, stat.st_size)
+
+    def close(self) -> None:
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        self._file_state = None
+
+
+class ChatDaemon:
+    """Serve chat requests from local clients with a warm API client.
+
+    Each request is a JSON line with the message content and optionally
+    the model, the prelude, the session name and whether to stream. The
+    response is sent as JSON lines of deltas, followed by a final
+    line with either done or error. Sessions are loaded from and saved to
+    the same files used by the direct mode, and the most recently used
+    ones are kept in memory.
+    """
+
+    def __init__(
+        self,
+        client: OpenAI,
+        data_dir: str,
+        model: str = DEFAULT_CHAT_MODEL,
+        cache: Optional[ResponseCache] = None,
+        scheduler: Optional[RequestScheduler] = None,
+        metrics: Optional[ChatMetrics] = None,
+        context_tokens: Optional[int] = None,
+    ):
+        self.client = client
+        self.data_dir = data_dir
+        self.model = model
+        self.cache = cache
+        self.scheduler = scheduler
+        self.metrics = metrics
+        self.context_tokens = context_tokens
+        self._lock = threading.Lock()
+        self._contexts: Dict[str, ContextWindow] = {}
+        self._sessions: OrderedDict[str, DaemonSession] = OrderedDict()
+
+    def _context(
+        self, model: str, session: Optional[DaemonSession] = None
+    ) -> Optional[ContextWindow]:
+        if self.context_tokens == 0:
+            return None
+        if session is not None:  # counts of the session history are kept
+            if session.context is None or session.context.model != model:
+                session.context = ContextWindow(model, self.context_tokens)
+            return session.context
+        with self._lock:
+            if model not in self._contexts:
+                self._contexts[model] = ContextWindow(model, self.context_tokens)
+            return self._contexts[model]
+
+    def _acquire_session(self, name: str) -> DaemonSession:
+        with self._lock:
+            session = self._sessions.get(name)
+            if session is None:
+                session_dir = os.path.join(self.data_dir, "sessions")
+                os.makedirs(session_dir, exist_ok=True)
+                session = DaemonSession(
+                    f"{session_dir}/{name}.json", open_session_index(self.data_dir)
+                )
+                self._sessions[name] = session
+            self._sessions.move_to_end(name)
+            session.users += 1
+            return session
+
+    def _release_session(self, session: DaemonSession) -> None:
+        with self._lock:
+            session.users -= 1
+            idle = [name for name, cached in self._sessions.items() if not cached.users]
+            for name in idle[: max(0, len(self._sessions) - DAEMON_SESSIONS_CACHED)]:
+                self._close_session(self._sessions.pop(name))
+
+    @staticmethod
+    def _close_session(session: DaemonSession) -> None:
+        session.close()
+        if session.index is not None:
+            session.index.close()
+
+    def close(self) -> None:
+        """Save and close the sessions kept in memory."""
+        with self._lock:
+            while self._sessions:
+                self._close_session(self._sessions.popitem()[1])
+
+    def handle(self, request: Dict[str, Any], output: Any) -> None:
+        """Handle a chat request, writing the JSON lines response to output."""
+        name = request.get("session")
+        if not name:
+            self._chat(request, output)
+            return
+        session = self._acquire_session(str(name))
+        try:
+            with session.lock:
+                self._chat(request, output, session)
+        finally:
+            self._release_session(session)
+
+    def _chat(
+        self,
+        request: Dict[str, Any],
+        output: Any,
+        session: Optional[DaemonSession] = None,
+    ) -> None:
+        model = str(request.get("model") or self.model)
+        content = str(request["content"])
+        if request.get("prelude"):
+            content = "{}\n{}".format(request["prelude"], content)
+        chat_history: ChatHistoryType = []
+        if session is not None:
+            chat_history = session.load()
+        saved = len(chat_history)
+        chat_history.append({"role": "user", "content": content})
+        try:
+            response = self._respond(model, chat_history, request, output, session)
+        except BaseException:  # keep the history as it's saved
+            del chat_history[saved:]
+            raise
+        chat_history.append({"role": "assistant", "content": response})
+        if session is not None:
+            session.save()
+        output.write((json.dumps({"done": True}) + "\n").encode("utf-8"))
+        output.flush()
+
+    def _respond(
+        self,
+        model: str,
+        chat_history: ChatHistoryType,
+        request: Dict[str, Any],
+        output: Any,
+        session: Optional[DaemonSession] = None,
+    ) -> str:
+        """Write the response to the chat history as JSON lines to output,
+        and return it."""
+        request_history = chat_history
+        context = self._context(model, session)
+        if context is not None:
+            request_history = context.fit(chat_history)
+        writer = JsonLinesWriter(output)
+        cache_key = None
+        response = None
+        if self.cache is not None:
+            cache_key = self.cache.make_key(model, request_history)
+            response = self.cache.get(cache_key)
+        if response is not None:
+            if self.metrics is not None:
+                self.metrics.record("cache_hit", model=model)
+            writer.write(response + "\n")
+        else:
+            if request.get("stream", True):
+                response = stream_chat_message(
+                    self.client,
+                    model,
+                    request_history,
+                    writer,  # type: ignore
+                    self.scheduler,
+                    self.metrics,
+                )
+            else:
+                response = send_chat_message(
+                    self.client, model, request_history, self.scheduler, self.metrics
+                )
+                writer.write(response + "\n")
+            if cache_key is not None:
+                self.cache.put(cache_key, response)
+        return response
+
+
+def make_daemon_server(socket_path: str, chat_daemon: ChatDaemon) -> Any:
+    """Return a server handling each connection to the Unix socket in a thread,
+    as a chat request to chat_daemon."""
+    import socketserver
+
+    class ChatRequestHandler(socketserver.StreamRequestHandler):
+        def handle(self) -> None:
+            import openai  # type: ignore  # noqa: F811
+
+            try:
+                request = json.loads(self.rfile.readline())
+                chat_daemon.handle(request, self.wfile)
+            except (ValueError, KeyError, TypeError) as err:
+                self._send_error("invalid request: {}".format(err))
+            except (openai.APIError, CacheMissError, OSError) as err:
+                logger.info("chat request failed: {}".format(err))
+                self._send_error(str(err))
+
+        def _send_error(self, message: str) -> None:
+            try:
+                error = json.dumps({"error": message}) + "\n"
+                self.wfile.write(error.encode("utf-8"))
+            except OSError:  # client is gone
+                pass
+
+    class ChatDaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    return ChatDaemonServer(socket_path, ChatRequestHandler)
+
+
+def serve_daemon(socket_path: str, chat_daemon: ChatDaemon) -> int:
+    """Serve chat requests on the Unix socket until interrupted."""
+    if os.path.exists(socket_path):
+        try:  # refuse to take over the socket of a running daemon
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(socket_path)
+            print(
+                "daemon is already running on {}".format(socket_path), file=sys.stderr
+            )
+            return os.EX_TEMPFAIL
+        except ConnectionRefusedError:
+            os.unlink(socket_path)
+    old_umask = os.umask(0o077)  # only the user can connect
+    try:
+        server = make_daemon_server(socket_path, chat_daemon)
+    finally:
+        os.umask(old_umask)
+    logger.info("daemon listening on {}".format(socket_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+        chat_daemon.close()
+    return os.EX_OK
+
+
+def send_to_daemon(
+    socket_path: str, request: Dict[str, Any], output: TextIO = sys.stdout
+) -> int:
+    """Send a chat request to the daemon, write the response to output
+    as it arrives, and return the exit code."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            print("daemon is not running on {}".format(socket_path), file=sys.stderr)
+            return os.EX_UNAVAILABLE
+        sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        with sock.makefile("r", encoding="utf-8") as responses:
+            for line in responses:
+                message = json.loads(line)
+                if "delta" in message:
+                    output.write(message["delta"])
+                    output.flush()
+                elif "error" in message:
+                    print(message["error"], file=sys.stderr)
+                    return os.EX_SOFTWARE
+                elif message.get("done"):
+                    return os.EX_OK
+    print("daemon closed the connection", file=sys.stderr)
+    return os.EX_SOFTWARE
+
+
 def get_system_info() -> str:
     """Return a string containing system information."""
+    import platform
 
     free_desktop_release = platform.freedesktop_os_release()
     os_name = free_desktop_release.get("NAME", platform.system())
@@ -223,8 +1745,64 @@ def get_system_info() -> str:
     )
 
 
-def make_client(opts: Namespace) -> OpenAI:
-    """Create OpenAI client confgured with proxy and API key based on the options."""
+def benchmark_startup(
+    target: float = STARTUP_IMPORT_TARGET, runs: int = STARTUP_BENCHMARK_RUNS
+) -> int:
+    """Measure the imports of a run that sends no request (--version) with
+    python -X importtime, and print the fastest of the runs.
+
+    Returns non zero if the imports take longer than target seconds,
+    or if any of the DEFERRED_MODULES are imported.
+    """
+    import subprocess
+
+    best = None
+    deferred_modules = set()
+    for _ in range(runs):
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", os.path.abspath(__file__), "-V"],
+            capture_output=True,
+            text=True,
+        )
+        elapsed = 0
+        for line in proc.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            fields = line.split("|")
+            if not line.startswith("import time:") or len(fields) != 3:
+                continue
+            try:
+                cumulative = int(fields[1])
+            except ValueError:  # the header
+                continue
+            name = fields[2].strip()
+            if name.split(".")[0] in DEFERRED_MODULES:
+                deferred_modules.add(name)
+            if not fields[2][1:].startswith(" "):  # nested imports are indented
+                elapsed += cumulative
+        if best is None or elapsed < best:
+            best = elapsed
+    seconds = (best or 0) / 1e6
+    print(
+        "startup imports took {:.1f}ms (target {:.1f}ms), best of {} runs".format(
+            seconds * 1000, target * 1000, runs
+        )
+    )
+    if deferred_modules:
+        print(
+            "imported deferred modules: {}".format(", ".join(sorted(deferred_modules)))
+        )
+        return os.EX_SOFTWARE
+    return os.EX_SOFTWARE if seconds > target else os.EX_OK
+
+
+def make_client(opts: Namespace, metrics: Optional[ChatMetrics] = None) -> OpenAI:
+    """Create OpenAI client confgured with proxy and API key based on the options.
+
+    If metrics is set, HTTP requests are traced to measure connection times.
+    """
+    import httpx  # type: ignore  # noqa: F811
+    import openai  # type: ignore  # noqa: F811
+
     proxy_conf = {}
     if opts.proxy is not None:
         proxy_conf["https://"] = opts.proxy
@@ -240,12 +1818,24 @@ def make_client(opts: Namespace) -> OpenAI:
             if not https_proxy.startswith("https://"):
                 https_proxy = "https://" + https_proxy
             proxy_conf["https://"] = https_proxy
-    client_kwargs = {}
+    client_kwargs: Dict[str, Any] = {}
     if opts.api_base is not None:
         client_kwargs["base_url"] = opts.api_base
+    # one keep-alive connection per concurrent request, shared by all requests
+    pool_size = max(HTTP_POOL_CONNECTIONS, getattr(opts, "jobs", 1))
+    limits = httpx.Limits(
+        max_connections=pool_size,
+        max_keepalive_connections=pool_size,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+    http_client_kwargs: Dict[str, Any] = {"limits": limits}
+    if metrics is not None:
+        http_client_kwargs["event_hooks"] = {"request": [metrics.trace_request]}
     if proxy_conf.keys():
-        client_kwargs["http_client"] = httpx.Client(proxies=proxy_conf)
-    client = OpenAI(api_key=opts.api_key, **client_kwargs)
+        http_client_kwargs["proxies"] = proxy_conf
+    client_kwargs["http_client"] = httpx.Client(**http_client_kwargs)
+    # retries are handled by the RequestScheduler
+    client = openai.OpenAI(api_key=opts.api_key, max_retries=0, **client_kwargs)
     return client
 
 
@@ -283,6 +1873,13 @@ def main(args: Optional[List[str]] = None) -> int:
         choices=CHAT_MODELS,
         help="Chat model to use",
     )
+    parser.add_argument(
+        "--context-tokens",
+        type=int,
+        metavar="TOKENS",
+        help="Token budget of the chat history sent to the model "
+        "(default is based on the model context size, 0 sends all the history)",
+    )
     parser.add_argument("-s", "--save-file", help="File path to save chat history")
     parser.add_argument("-l", "--load-file", help="File path to load chat history")
     parser.add_argument(
@@ -292,6 +1889,101 @@ def main(args: Optional[List[str]] = None) -> int:
         help="Name of the session to save/load chat history (not used with save/load, "
         "stored in {})".format(data_dir),
     )
+    parser.add_argument(
+        "--list-sessions",
+        nargs="?",
+        const="recent",
+        choices=("recent", "size"),
+        help="List the saved sessions, the most recent (default) or largest first",
+    )
+    parser.add_argument(
+        "--search",
+        metavar="QUERY",
+        help="Search the messages of the saved sessions",
+    )
+    parser.add_argument(
+        "--stream",
+        action=BooleanOptionalAction,
+        default=sys.stdout.isatty(),
+        help="Print the response as it arrives (default is on for terminals)",
+    )
+    parser.add_argument(
+        "--batch",
+        metavar="FILE",
+        help="Send each JSON line of the file (- for stdin) as an independent prompt",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=DEFAULT_BATCH_JOBS,
+        help="Number of concurrent requests in batch mode (default %(default)s)",
+    )
+    parser.add_argument(
+        "--batch-order",
+        choices=("input", "completion"),
+        default="input",
+        help="Order of the batch results (default %(default)s)",
+    )
+    cache_group = parser.add_mutually_exclusive_group()
+    cache_group.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not use the response cache",
+    )
+    cache_group.add_argument(
+        "--cache-only",
+        action="store_true",
+        help="Only use cached responses, fail if a response is not cached",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=int,
+        default=DEFAULT_CACHE_TTL,
+        metavar="SECONDS",
+        help="Expire cached responses after this many seconds (default %(default)s)",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=DEFAULT_RETRIES,
+        help="Retry rate limited and failed requests this many times "
+        "(default %(default)s)",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Serve chat requests on a Unix socket, keeping the client warm",
+    )
+    parser.add_argument(
+        "--connect",
+        action="store_true",
+        help="Send the message to the daemon instead of the API",
+    )
+    parser.add_argument(
+        "--socket",
+        metavar="PATH",
+        default=os.path.join(data_dir, "oaichat.sock"),
+        help="Unix socket path of the daemon (default %(default)s)",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Print a summary of request latencies and token usage at exit",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        metavar="FILE",
+        help="Append the metrics of each request and save as JSON lines to the file",
+    )
+    parser.add_argument(
+        "--benchmark-startup",
+        action="store_true",
+        help="Measure the startup imports with python -X importtime, "
+        "fail if over {:.0f}ms or if deferred modules are imported".format(
+            STARTUP_IMPORT_TARGET * 1000
+        ),
+    )
     parser.add_argument(
         "--sys",
         action="store_true",
@@ -312,6 +2004,43 @@ def main(args: Optional[List[str]] = None) -> int:
     elif opts.verbosity >= 2:
         logger.setLevel(logging.DEBUG)
 
+    if opts.benchmark_startup:
+        return benchmark_startup()
+
+    session_dir = os.path.join(data_dir, "sessions")
+    if opts.list_sessions or opts.search:
+        return query_sessions(opts, data_dir, session_dir)
+
+    prelude = str(opts.prelude or "").strip()
+    if opts.sys:
+        prelude = "Given current system information is {}, {}".format(
+            get_system_info(), prelude
+        )
+
+    if opts.connect:
+        if opts.save_file or opts.load_file or opts.batch or opts.daemon:
+            print(
+                "Cannot use --connect along with --save, --load, --batch or --daemon.",
+                file=sys.stderr,
+            )
+            return os.EX_USAGE
+        if sys.stdin.isatty():
+            print("Press Ctrl+D (EOF) to send the message.", file=sys.stderr)
+        content = read_input().strip()
+        if not content:
+            return os.EX_OK
+        request = {
+            "content": content,
+            "model": opts.model,
+            "prelude": prelude,
+            "session": opts.session,
+            "stream": bool(opts.stream),
+        }
+        try:
+            return send_to_daemon(opts.socket, request, sys.stdout)
+        except KeyboardInterrupt:
+            return os.EX_TEMPFAIL
+
     if opts.api_key is None:
         if os.environ.get("OPENAI_API_KEY"):
             opts.api_key = os.environ["OPENAI_API_KEY"]
@@ -319,9 +2048,173 @@ def main(args: Optional[List[str]] = None) -> int:
             print("Please specify OpenAI API key", file=sys.stderr)
             return os.EX_CONFIG
 
-    client = make_client(opts)
+    metrics = None
+    if opts.stats or opts.metrics_file:
+        metrics = ChatMetrics(opts.metrics_file)
+
+    client = make_client(opts, metrics)
+
+    cache = None
+    if not opts.no_cache:
+        import sqlite3
+
+        os.makedirs(data_dir, exist_ok=True)
+        try:
+            cache = ResponseCache(
+                os.path.join(data_dir, "cache.db"),
+                opts.cache_ttl,
+                only=opts.cache_only,
+            )
+        except sqlite3.Error as err:
+            if opts.cache_only:
+                print(
+                    "response cache is not available: {}".format(err), file=sys.stderr
+                )
+                return os.EX_UNAVAILABLE
+            logger.warning("response cache is not available: {}".format(err))
+
+    scheduler = RequestScheduler(max(0, opts.retries))
+    try:
+        return run(opts, client, data_dir, prelude, cache, scheduler, metrics)
+    finally:
+        if cache is not None:
+            cache.close()
+        if metrics is not None:
+            if opts.stats:
+                print(metrics.summary(), file=sys.stderr)
+            metrics.close()
+
+
+def open_session_index(data_dir: str) -> Optional[SessionIndex]:
+    """Open the session index in the data directory, None if not supported.
+
+    >>> import sqlite3
+    >>> class NoFTS5Connection(sqlite3.Connection):
+    ...     def executescript(self, script):
+    ...         if "USING fts5" in script:
+    ...             raise sqlite3.OperationalError("no such module: fts5")
+    ...         return super().executescript(script)
+    >>> connect = sqlite3.connect
+    >>> sqlite3.connect = lambda *args, **kwargs: connect(
+    ...     *args, factory=NoFTS5Connection, **kwargs
+    ... )
+    >>> logger.disabled = True  # the warnings of the missing index
+    >>> data_dir = tempfile.mkdtemp()
+    >>> print(open_session_index(data_dir))
+    None
+    >>> os.makedirs(os.path.join(data_dir, "sessions"))
+    >>> opts = Namespace(search="cats", list_sessions=None)
+    >>> status = query_sessions(opts, data_dir, os.path.join(data_dir, "sessions"))
+    >>> status == os.EX_UNAVAILABLE
+    True
+    >>> sqlite3.connect, logger.disabled = connect, False
+    """
+    import sqlite3
+
+    try:
+        return SessionIndex(os.path.join(data_dir, "sessions.db"))
+    except sqlite3.OperationalError as err:  # SQLite built without FTS5
+        logger.warning("session index is not available: {}".format(err))
+        return None
+
 
-    chat_callback = None
+def query_sessions(opts: Namespace, data_dir: str, session_dir: str) -> int:
+    """List or search the saved sessions based on the options, return exit code."""
+    if not os.path.isdir(session_dir):
+        return os.EX_OK
+    index = open_session_index(data_dir)
+    if index is None:
+        return os.EX_UNAVAILABLE
+    try:
+        index.sync(session_dir)
+        if opts.search:
+            for name, position, role, snippet in index.search(opts.search):
+                snippet = snippet.replace("\n", " ")
+                print("{}:{} [{}] {}".format(name, position, role, snippet))
+        else:
+            for name, mtime, size, messages in index.list_sessions(opts.list_sessions):
+                print(
+                    "{:<32} {:%Y-%m-%d %H:%M} {:>10} bytes {:>6} messages".format(
+                        name, datetime.fromtimestamp(mtime), size, messages
+                    )
+                )
+    finally:
+        index.close()
+    return os.EX_OK
+
+
+def run(
+    opts: Namespace,
+    client: OpenAI,
+    data_dir: str,
+    prelude: str,
+    cache: Optional[ResponseCache],
+    scheduler: Optional[RequestScheduler] = None,
+    metrics: Optional[ChatMetrics] = None,
+) -> int:
+    """Run the chat, the batch or the daemon based on the options,
+    return exit code."""
+    import openai  # type: ignore  # noqa: F811
+
+    if opts.daemon:
+        if opts.session or opts.save_file or opts.load_file or opts.batch:
+            print(
+                "Cannot use --daemon along with --session, --save, --load or --batch.",
+                file=sys.stderr,
+            )
+            return os.EX_USAGE
+        os.makedirs(os.path.dirname(os.path.abspath(opts.socket)), exist_ok=True)
+        chat_daemon = ChatDaemon(
+            client,
+            data_dir,
+            str(opts.model),
+            cache,
+            scheduler,
+            metrics,
+            opts.context_tokens,
+        )
+        return serve_daemon(opts.socket, chat_daemon)
+
+    if opts.batch:
+        if opts.session or opts.save_file or opts.load_file:
+            print(
+                "Cannot use --batch along with --session, --save or --load.",
+                file=sys.stderr,
+            )
+            return os.EX_USAGE
+        try:
+            if opts.batch == "-":
+                failures = run_batch(
+                    client,
+                    str(opts.model),
+                    sys.stdin,
+                    sys.stdout,
+                    prelude,
+                    opts.jobs,
+                    opts.batch_order == "input",
+                    cache,
+                    scheduler,
+                    metrics,
+                )
+            else:
+                with open(opts.batch, "r", encoding="utf-8") as prompts:
+                    failures = run_batch(
+                        client,
+                        str(opts.model),
+                        prompts,
+                        sys.stdout,
+                        prelude,
+                        opts.jobs,
+                        opts.batch_order == "input",
+                        cache,
+                        scheduler,
+                        metrics,
+                    )
+        except KeyboardInterrupt:
+            return os.EX_TEMPFAIL
+        return os.EX_SOFTWARE if failures else os.EX_OK
+
+    chat_callback: Optional[ChatHistoryLog] = None
     # Check if --session argument is passed
     if opts.session:
         if opts.save_file or opts.load_file:
@@ -332,31 +2225,46 @@ def main(args: Optional[List[str]] = None) -> int:
         session_dir = os.path.join(data_dir, "sessions")
         os.makedirs(session_dir, exist_ok=True)
         session_file = f"{session_dir}/{session_name}.json"
-        chat_callback = partial(save_chat_history, session_file)
-        chat_history = (
-            load_chat_history(session_file) if os.path.exists(session_file) else []
-        )
+        session_index = open_session_index(data_dir)
+        chat_history, chat_callback = open_session_log(session_file, session_index)
     else:  # no session
         if opts.save_file:
-            chat_callback = partial(save_chat_history, opts.save_file)
+            chat_callback = ChatHistoryLog(opts.save_file)
         if opts.load_file and os.path.exists(opts.load_file):
             chat_history = load_chat_history(opts.load_file)
         else:
             chat_history = []
 
-    prelude = str(opts.prelude).strip()
-    if opts.sys:
-        prelude = "Given current system information is {}, {}".format(
-            get_system_info(), prelude
-        )
+    context = None
+    if opts.context_tokens != 0:
+        context = ContextWindow(str(opts.model), opts.context_tokens)
 
     try:
-        start_chat(client, str(opts.model), prelude, chat_history, chat_callback)
-    except APIError as err:
+        start_chat(
+            client,
+            str(opts.model),
+            prelude,
+            chat_history,
+            chat_callback,
+            bool(opts.stream),
+            context,
+            cache,
+            scheduler,
+            metrics,
+        )
+    except openai.APIError as err:
         logger.exception(err)
         return os.EX_SOFTWARE
+    except CacheMissError as err:
+        print(str(err), file=sys.stderr)
+        return os.EX_UNAVAILABLE
     except KeyboardInterrupt:
         return os.EX_TEMPFAIL
+    finally:
+        if chat_callback is not None:
+            chat_callback.close()
+            if chat_callback.index is not None:
+                chat_callback.index.close()
     return os.EX_OK
 
 
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Run the doctests of the scripts in bin/.
+
+Scripts are loaded as modules by their path, as some of them have no .py
+extension. Scripts missing their dependencies are skipped.
+
+    python3 tests/run_doctests.py [SCRIPT...]
+"""
+import sys
+import os
+import doctest
+from importlib.machinery import SourceFileLoader
+from importlib.util import module_from_spec, spec_from_loader
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "bin")
+SCRIPTS = ("colortrans.py", "oaichat.py", "rgit", "ftpd")
+
+
+def load_script(path):
+    name = os.path.splitext(os.path.basename(path))[0]
+    loader = SourceFileLoader(name, path)
+    module = module_from_spec(spec_from_loader(name, loader))
+    sys.modules[name] = module  # for doctests importing from the script
+    loader.exec_module(module)
+    return module
+
+
+def main(args):
+    failed = 0
+    for script in args or SCRIPTS:
+        try:
+            module = load_script(os.path.join(BIN_DIR, script))
+        except (ImportError, SystemExit) as err:
+            print("{}: skipped, failed to load ({})".format(script, err))
+            continue
+        results = doctest.testmod(module)
+        print(
+            "{}: {} tests, {} failed".format(script, results.attempted, results.failed)
+        )
+        failed += results.failed
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))